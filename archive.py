@@ -0,0 +1,190 @@
+# archive.py
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import pandas as pd
+from pathlib import Path
+from urllib.parse import quote
+from extract import RAW_DIR
+from transform import (STAGING_FORMAT, ensure_pollutant_columns, engineer_features, list_staged_files,
+                       read_raw_file, read_staged, staged_file_path, write_staged)
+from instrumentation import stage
+from jsonio import write_json_atomic
+from rolling import TAIL_HOURS, add_rolling_features, empty_tails
+
+BASE_DIR = Path(__file__).resolve().parents[0]
+
+# Compacted store: <kind>/city=<city>/date=<YYYY-MM-DD>.parquet plus a manifest
+ARCHIVE_DIR = Path(os.getenv("ARCHIVE_DIR", BASE_DIR / "data" / "archive"))
+MANIFEST_FILE = ARCHIVE_DIR / "manifest.json"
+KINDS = ("raw", "staged")
+
+# Loose files younger than this (seconds) are left for a later pass
+ARCHIVE_MIN_AGE = float(os.getenv("ARCHIVE_MIN_AGE", "0"))
+ARCHIVE_BATCH_FILES = int(os.getenv("ARCHIVE_BATCH_FILES", "500"))  # loose files folded per pass
+
+FILE_TIMESTAMP = re.compile(r"(\d{8}_\d{6})")
+DAY_FORMAT = "%Y-%m-%d"
+TIME_FORMAT = "%Y-%m-%dT%H:%M"
+
+def load_manifest():
+    """Returns {kind: {city: {day: {path, rows, start, end}}}}."""
+    if not MANIFEST_FILE.exists():
+        return {kind: {} for kind in KINDS}
+    manifest = json.loads(MANIFEST_FILE.read_text())
+    for kind in KINDS:
+        manifest.setdefault(kind, {})
+    return manifest
+
+def save_manifest(manifest):
+    ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
+    write_json_atomic(MANIFEST_FILE, manifest, indent=2, sort_keys=True)
+
+def partition_path(kind, city, day):
+    return ARCHIVE_DIR / kind / f"city={quote(str(city), safe='')}" / f"date={day}.parquet"
+
+def file_timestamp(path):
+    """Run timestamp embedded in a raw/staged file name; files sort oldest first."""
+    match = FILE_TIMESTAMP.search(Path(path).name)
+    return (match.group(1) if match else "", Path(path).name)
+
+def loose_files(kind, min_age=ARCHIVE_MIN_AGE):
+    files = RAW_DIR.glob("*_raw_*.json*") if kind == "raw" else map(Path, list_staged_files())
+    cutoff = time.time() - min_age
+    return sorted((p for p in files if p.stat().st_mtime <= cutoff), key=file_timestamp)
+
+def read_loose(kind, path):
+    df = read_raw_file(path) if kind == "raw" else read_staged(path)
+    if df is None:
+        return None
+    df["time"] = pd.to_datetime(df["time"], errors="coerce")
+    # Plain object columns so partitions written from csv and parquet staging concat cleanly
+    for col in df.select_dtypes(include="category").columns:
+        df[col] = df[col].astype(object)
+    return df[df["time"].notna()]
+
+def merge_partition(path, rows):
+    """Folds `rows` into a partition file; on overlapping hours the newer row wins."""
+    if path.exists():
+        rows = pd.concat([pd.read_parquet(path), rows], ignore_index=True)
+    rows = rows.drop_duplicates(subset=["city", "time"], keep="last").sort_values("time")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    rows.to_parquet(tmp, index=False)
+    tmp.replace(path)
+    return rows
+
+def compact_files(kind, files, manifest):
+    """Folds one batch of loose files into the archive; returns the files that were absorbed."""
+    frames, absorbed = [], []
+    for path in files:
+        df = read_loose(kind, path)
+        if df is not None:
+            frames.append(df)
+            absorbed.append(path)
+    frames = [df for df in frames if not df.empty]
+    if not frames:
+        return absorbed
+
+    # Files are in run order, so keep="last" in merge_partition prefers the latest fetch
+    df = pd.concat(frames, ignore_index=True)
+    for (city, day), rows in df.groupby([df["city"], df["time"].dt.strftime(DAY_FORMAT)], sort=False):
+        path = partition_path(kind, city, day)
+        merged = merge_partition(path, rows)
+        manifest[kind].setdefault(str(city), {})[day] = {
+            "path": str(path.relative_to(ARCHIVE_DIR)),
+            "rows": len(merged),
+            "start": merged["time"].min().strftime(TIME_FORMAT),
+            "end": merged["time"].max().strftime(TIME_FORMAT),
+        }
+    return absorbed
+
+def compact(kinds=KINDS, remove=True, min_age=ARCHIVE_MIN_AGE, batch_files=ARCHIVE_BATCH_FILES):
+    """
+    Folds loose raw/staged files into the partitioned archive. Loose files are
+    only deleted after the partitions and manifest covering them are written.
+    """
+    manifest = load_manifest()
+    total = 0
+    with stage("compact") as metrics:
+        for kind in kinds:
+            files = loose_files(kind, min_age)
+            if not files:
+                continue
+            print(f"🗜️  Compacting {len(files)} loose {kind} files into {ARCHIVE_DIR / kind}...")
+            for start in range(0, len(files), max(1, batch_files)):
+                absorbed = compact_files(kind, files[start:start + batch_files], manifest)
+                save_manifest(manifest)
+                if remove:
+                    for path in absorbed:
+                        path.unlink(missing_ok=True)
+                total += len(absorbed)
+        metrics["files"] = total
+    print(f"✅ Compaction complete ({total} files absorbed).")
+    return total
+
+def find_partitions(kind, cities=None, start=None, end=None):
+    """Archive files overlapping [start, end] for `cities`, straight from the manifest."""
+    manifest = load_manifest()[kind]
+    start = pd.Timestamp(start).strftime(TIME_FORMAT) if start is not None else None
+    end = pd.Timestamp(end).strftime(TIME_FORMAT) if end is not None else None
+    paths = []
+    for city in cities or sorted(manifest):
+        for day, entry in sorted(manifest.get(city, {}).items()):
+            # Fixed-width timestamps compare correctly as strings
+            if (start is None or entry["end"] >= start) and (end is None or entry["start"] <= end):
+                paths.append(ARCHIVE_DIR / entry["path"])
+    return paths
+
+def read_archive(kind, cities=None, start=None, end=None):
+    """Rows of one kind for `cities` within [start, end] (inclusive)."""
+    paths = find_partitions(kind, cities, start, end)
+    if not paths:
+        return pd.DataFrame()
+    df = pd.concat([pd.read_parquet(p) for p in paths], ignore_index=True)
+    if start is not None:
+        df = df[df["time"] >= pd.Timestamp(start)]
+    if end is not None:
+        df = df[df["time"] <= pd.Timestamp(end)]
+    return df.reset_index(drop=True)
+
+def reprocess(cities=None, start=None, end=None, staging_format=STAGING_FORMAT):
+    """Re-runs the transform over archived raw hours and stages the result (watermarks ignored)."""
+    # Rolling windows at the start of the range reach back TAIL_HOURS before it
+    lookback = pd.Timestamp(start) - pd.Timedelta(hours=TAIL_HOURS) if start is not None else None
+    raw = read_archive("raw", cities, lookback, end)
+    if not raw.empty:
+        staged = engineer_features(ensure_pollutant_columns(raw), watermarks={})
+        staged = add_rolling_features(staged, empty_tails())
+        if start is not None:
+            staged = staged[staged["time"] >= pd.Timestamp(start)]
+    if raw.empty or staged.empty:
+        print("ℹ️  No archived raw data in that range.")
+        return None
+    path = staged_file_path(staging_format, tag="reprocess")
+    write_staged(staged, path)
+    print(f"✅ Reprocessed {len(staged)} rows into {path}")
+    return str(path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact and query the partitioned raw/staged archive")
+    parser.add_argument("command", nargs="?", choices=["compact", "find", "reprocess"], default="compact")
+    parser.add_argument("--kind", choices=KINDS, default="raw")
+    parser.add_argument("--city", action="append", help="repeat for several cities (default: all)")
+    parser.add_argument("--start", help="e.g. 2025-12-11T00:00")
+    parser.add_argument("--end")
+    parser.add_argument("--keep", action="store_true", help="compact without deleting loose files")
+    parser.add_argument("--min-age", type=float, default=ARCHIVE_MIN_AGE,
+                        help="only compact loose files older than this many seconds")
+    args = parser.parse_args()
+
+    if args.command == "compact":
+        compact(remove=not args.keep, min_age=args.min_age)
+    elif args.command == "find":
+        for path in find_partitions(args.kind, args.city, args.start, args.end):
+            print(path)
+    else:
+        sys.exit(0 if reprocess(args.city, args.start, args.end) else 1)
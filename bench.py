@@ -0,0 +1,269 @@
+# bench.py
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import importlib.util
+import platform
+import statistics
+import tempfile
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parents[0]
+BENCH_DIR = BASE_DIR / "data" / "bench"
+BENCH_DIR.mkdir(parents=True, exist_ok=True)
+
+# Benchmark settings (override via .env / environment or the command line)
+BENCH_BASELINE = Path(os.getenv("BENCH_BASELINE", BENCH_DIR / "baseline.json"))
+BENCH_THRESHOLD = float(os.getenv("BENCH_THRESHOLD", "0.20"))  # allowed slowdown vs baseline (20%)
+BENCH_NOISE_FLOOR = float(os.getenv("BENCH_NOISE_FLOOR", "0.01"))  # seconds; smaller deltas are noise
+BENCH_REPEAT = int(os.getenv("BENCH_REPEAT", "3"))
+
+PRESETS = {
+    "small": (5, 24 * 7),       # 5 cities x 1 week
+    "medium": (100, 24 * 30),   # 100 cities x 1 month
+    "large": (1000, 24 * 365),  # 1000 cities x 1 year
+}
+
+# Keep every bit of pipeline state in a scratch directory: nothing real is read or touched
+SCRATCH = Path(tempfile.mkdtemp(prefix="atmos_bench_"))
+os.environ.update({
+    "WATERMARK_FILE": str(SCRATCH / "watermarks.json"),
+    "UTC_OFFSET_FILE": str(SCRATCH / "utc_offsets.json"),
+    "ROLLUP_FILE": str(SCRATCH / "rollups.json"),
+    "ROLLING_TAIL_FILE": str(SCRATCH / "rolling_tail.json"),
+    "DUCKDB_PATH": str(SCRATCH / "bench.duckdb"),
+    "ANALYSIS_BACKEND": "duckdb",
+    "METRICS_ENABLED": "0",
+    # The REST loader only needs credentials to build its session; uploads are stubbed
+    "SUPABASE_URL": "http://bench.invalid",
+    "SUPABASE_KEY": "bench",
+})
+
+import transform
+import load
+from jsonio import write_json
+from transform import POLLUTANTS, read_staged, transform_data
+from rollups import build_rollups, rollup_kpis
+from rolling import add_rolling_features, empty_tails
+
+# Rough scale per pollutant (lognormal median) so AQI/risk labels spread realistically
+POLLUTANT_SCALE = {
+    "pm10": 90.0, "pm2_5": 55.0, "carbon_monoxide": 600.0, "nitrogen_dioxide": 25.0,
+    "sulphur_dioxide": 10.0, "ozone": 60.0, "uv_index": 3.0,
+}
+
+def synthetic_payload(city, hours, rng, start="2025-01-01T00:00"):
+    """One Open-Meteo air-quality response (`hourly` arrays) for `hours` hours."""
+    times = pd.date_range(start, periods=hours, freq="h").strftime("%Y-%m-%dT%H:%M")
+    # Diurnal cycle plus noise; ~1% gaps like the real API returns
+    diurnal = 1 + 0.4 * np.sin(np.arange(hours) * 2 * np.pi / 24)
+    hourly = {"time": list(times)}
+    for col in POLLUTANTS:
+        values = POLLUTANT_SCALE[col] * diurnal * rng.lognormal(0, 0.5, hours)
+        values = np.round(values, 1).astype(object)
+        values[rng.random(hours) < 0.01] = None
+        hourly[col] = values.tolist()
+    return {
+        "latitude": round(float(rng.uniform(8, 35)), 4),
+        "longitude": round(float(rng.uniform(68, 97)), 4),
+        "timezone": "Asia/Kolkata",
+        "hourly_units": {"time": "iso8601"},
+        "hourly": hourly,
+        "city_name": city,
+    }
+
+def generate_raw(cities, hours, out_dir, seed=42):
+    """Writes one raw file per synthetic city (same format as extract.save_raw)."""
+    rng = np.random.default_rng(seed)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    return [
+        str(write_json(out_dir / f"city{i:04d}_raw_bench.json", synthetic_payload(f"City{i:04d}", hours, rng)))
+        for i in range(cities)
+    ]
+
+def reset_state():
+    for name in ["watermarks.json", "utc_offsets.json", "rollups.json", "rolling_tail.json", "bench.duckdb",
+                 "bench.duckdb.wal"]:
+        (SCRATCH / name).unlink(missing_ok=True)
+
+def timed(fn, repeat, setup=None):
+    """Median wall time of `fn()` over `repeat` runs; returns (seconds, last result)."""
+    times, result = [], None
+    for _ in range(max(1, repeat)):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - started)
+    return statistics.median(times), result
+
+class StubUpload:
+    """Stands in for the PostgREST call: counts payloads instead of sending them."""
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+
+    def __call__(self, payload):
+        self.requests += 1
+        self.bytes += len(payload)
+
+def run_benchmarks(cities, hours, repeat=BENCH_REPEAT, only=None):
+    results = {}
+
+    def record(name, seconds, rows=None):
+        if only and not any(name.startswith(prefix) for prefix in only):
+            return
+        results[name] = {"seconds": round(seconds, 6)}
+        if rows:
+            results[name]["rows"] = rows
+            results[name]["rows_per_s"] = round(rows / seconds, 1) if seconds else None
+        print(f"   ⏱️  {name:<28} {seconds:9.4f}s" + (f"  ({rows} rows)" if rows else ""))
+
+    def wanted(*sections):
+        # A section runs if any requested prefix overlaps it ("kpi" or "kpi.top_event")
+        return not only or any(
+            n.startswith(prefix) or prefix.startswith(n) for n in sections for prefix in only
+        )
+
+    print(f"🧪 Generating {cities} cities x {hours} hours of synthetic raw JSON...")
+    started = time.perf_counter()
+    raw_files = generate_raw(cities, hours, SCRATCH / "raw")
+    record("generate", time.perf_counter() - started, cities * hours)
+
+    # --- A. Transform ---
+    transform.STAGED_DIR = SCRATCH / "staged"
+    transform.STAGED_DIR.mkdir(exist_ok=True)
+    seconds, staged = timed(lambda: transform_data(raw_files), repeat, setup=reset_state)
+    df = read_staged(staged)
+    record("transform", seconds, len(df))
+    # Rolling windows alone, over every row (the full-recompute worst case)
+    seconds, _ = timed(lambda: add_rolling_features(df.copy(), empty_tails()), repeat)
+    record("transform.rolling", seconds, len(df))
+
+    # --- B. Sanitize + serialize + load against a stub backend ---
+    if wanted("load"):
+        seconds, records = timed(lambda: load.sanitize_frame(read_staged(staged)), repeat)
+        record("load.sanitize", seconds, len(records))
+
+        def serialize():
+            rows, step = load.payload_rows(records), load.LOAD_BATCH_SIZE
+            return sum(len(load.batch_payload(rows, i, i + step)) for i in range(0, len(rows), step))
+        seconds, _ = timed(serialize, repeat)
+        record("load.serialize", seconds, len(records))
+
+        stub = StubUpload()
+        load.upsert_payload = stub
+        load.ensure_table = lambda columns=(): None
+        load.DEAD_LETTER_DIR = SCRATCH / "dead_letter"
+        load.DEAD_LETTER_DIR.mkdir(exist_ok=True)
+        seconds, rows = timed(lambda: load.load_to_supabase(staged), repeat, setup=reset_state)
+        record("load.rest_stub", seconds, rows)
+
+    # --- C. Local store + each analysis KPI ---
+    if importlib.util.find_spec("duckdb") is None:
+        print("   ⚠️ duckdb not installed, skipping local store and SQL KPI benchmarks.")
+    elif wanted("load.duckdb", "kpi"):
+        from local_store import connect, load_to_duckdb
+        from sql_analysis import AGGREGATE_QUERIES, TABLES
+        seconds, rows = timed(lambda: load_to_duckdb(staged), repeat, setup=reset_state)
+        record("load.duckdb", seconds, rows)
+
+        with connect() as con:
+            for name, sql in AGGREGATE_QUERIES.items():
+                seconds, _ = timed(lambda: con.execute(sql.format(table=TABLES["duckdb"])).df(), repeat)
+                record(f"kpi.{name}", seconds)
+
+        from etl_analysis import fetch_kpis
+        seconds, _ = timed(fetch_kpis, repeat)
+        record("kpi.all_duckdb", seconds)
+
+    if wanted("kpi"):
+        seconds, state = timed(lambda: build_rollups(df), repeat)
+        record("kpi.rollups_build", seconds, len(df))
+        seconds, _ = timed(lambda: rollup_kpis(state), repeat)
+        record("kpi.rollups_read", seconds)
+
+    return results
+
+def compare(results, baseline, threshold=BENCH_THRESHOLD, noise_floor=BENCH_NOISE_FLOOR):
+    """Names of benchmarks slower than baseline by more than `threshold` (and the noise floor)."""
+    regressions = []
+    for name, result in results.items():
+        # Data generation is harness overhead, not pipeline code
+        if name not in baseline or name == "generate":
+            continue
+        before, now = baseline[name]["seconds"], result["seconds"]
+        change = (now - before) / before if before else 0.0
+        slower = now - before > noise_floor and change > threshold
+        status = "❌" if slower else "✅"
+        print(f"   {status} {name:<28} {before:9.4f}s -> {now:9.4f}s ({change:+.1%})")
+        if slower:
+            regressions.append(name)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AtmosTrack pipeline benchmarks (synthetic Open-Meteo data)")
+    parser.add_argument("--preset", choices=PRESETS, default="small")
+    parser.add_argument("--cities", type=int, help="override the preset city count")
+    parser.add_argument("--hours", type=int, help="override the preset hour count")
+    parser.add_argument("--repeat", type=int, default=BENCH_REPEAT, help="runs per benchmark (median is kept)")
+    parser.add_argument("--only", help="comma-separated benchmark name prefixes, e.g. transform,kpi")
+    parser.add_argument("--threshold", type=float, default=BENCH_THRESHOLD)
+    parser.add_argument("--baseline", type=Path, default=BENCH_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="store this run as the new baseline")
+    args = parser.parse_args(argv)
+
+    cities, hours = PRESETS[args.preset]
+    cities, hours = args.cities or cities, args.hours or hours
+    scenario = f"{cities}x{hours}"
+    only = args.only.split(",") if args.only else None
+
+    print("===================================================")
+    print(f"🏁 ATMOSTRACK BENCHMARKS ({scenario}, median of {args.repeat})")
+    print("===================================================")
+    try:
+        results = run_benchmarks(cities, hours, args.repeat, only)
+    finally:
+        shutil.rmtree(SCRATCH, ignore_errors=True)
+
+    run = {
+        "scenario": scenario,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "config": {k: os.getenv(k) for k in ["STAGING_FORMAT", "TRANSFORM_STREAM", "TRANSFORM_WORKERS",
+                                             "JSON_BACKEND", "LOAD_BATCH_SIZE"] if os.getenv(k)},
+        "results": results,
+    }
+    out = BENCH_DIR / f"bench_{scenario}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    out.write_text(json.dumps(run, indent=2))
+    print(f"\n💾 Results saved to {out}")
+
+    # Baseline file holds one entry per scenario so presets don't overwrite each other
+    baselines = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    if args.save_baseline:
+        baselines[scenario] = run
+        args.baseline.write_text(json.dumps(baselines, indent=2))
+        print(f"📌 Baseline for {scenario} saved to {args.baseline}")
+        return 0
+    if scenario not in baselines:
+        print(f"ℹ️  No baseline for {scenario} yet (run with --save-baseline).")
+        return 0
+
+    print(f"\n📈 Against baseline ({baselines[scenario]['timestamp']}, threshold {args.threshold:.0%}):")
+    regressions = compare(results, baselines[scenario]["results"], args.threshold)
+    if regressions:
+        print(f"❌ {len(regressions)} benchmark(s) regressed: {', '.join(regressions)}")
+        return 1
+    print("✅ No regressions.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,39 @@
+# clients.py
+import os
+from functools import lru_cache
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Clients are built on first use and cached, so importing pipeline modules
+# (or running a stage that never talks to Supabase) costs no handshake.
+
+def supabase_credentials():
+    url, key = os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY")
+    if not url or not key:
+        raise SystemExit("Please check .env for SUPABASE_URL and SUPABASE_KEY")
+    return url, key
+
+@lru_cache(maxsize=None)
+def get_supabase():
+    """Cached Supabase client (supabase-py is only imported here)."""
+    from supabase import create_client
+
+    return create_client(*supabase_credentials())
+
+@lru_cache(maxsize=None)
+def get_rest_session(pool_size=4):
+    """Cached keep-alive session for direct PostgREST calls, with auth headers set."""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    url, key = supabase_credentials()
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_maxsize=max(1, pool_size)))
+    session.mount("https://", HTTPAdapter(pool_maxsize=max(1, pool_size)))
+    session.headers.update({
+        "apikey": key,
+        "Authorization": f"Bearer {key}",
+        "Content-Type": "application/json",
+    })
+    return session
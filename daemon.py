@@ -0,0 +1,200 @@
+# daemon.py
+import os
+import json
+import time
+import signal
+import threading
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+try:
+    import fcntl  # Unix only; elsewhere only in-process overlap is prevented
+except ImportError:
+    fcntl = None
+
+import instrumentation
+from extract import MAX_WORKERS, create_session
+from load import LOAD_BACKEND, backoff_delay
+from run_pipeline import COMPACT_AFTER_RUN, STREAM_PIPELINE, run_full_pipeline
+from watermark import STATE_DIR
+
+# Schedule: cycles start `DAEMON_OFFSET` seconds after each `DAEMON_INTERVAL` boundary,
+# e.g. hh:05 every hour, giving the upstream model update time to publish
+DAEMON_INTERVAL = int(os.getenv("DAEMON_INTERVAL", "3600"))
+DAEMON_OFFSET = int(os.getenv("DAEMON_OFFSET", "300"))
+
+# Transient failures are retried with full-jitter backoff before waiting for the next slot
+DAEMON_MAX_RETRIES = int(os.getenv("DAEMON_MAX_RETRIES", "3"))
+RETRY_BASE = float(os.getenv("DAEMON_RETRY_BASE", "30"))
+RETRY_CAP = float(os.getenv("DAEMON_RETRY_CAP", "600"))
+
+# Local status endpoint (GET /health, GET /status); port 0 disables it
+STATUS_HOST = os.getenv("DAEMON_STATUS_HOST", "127.0.0.1")
+STATUS_PORT = int(os.getenv("DAEMON_STATUS_PORT", "8765"))
+
+# Also keeps cron-started runs from overlapping a daemon cycle
+LOCK_FILE = Path(os.getenv("PIPELINE_LOCK_FILE", STATE_DIR / "pipeline.lock"))
+
+status = {
+    "state": "starting",
+    "started": datetime.now().isoformat(timespec="seconds"),
+    "cycles": 0,
+    "failures": 0,
+    "skipped": 0,
+    "next_run": None,
+    "last_cycle": None,
+}
+status_lock = threading.Lock()
+
+def next_run_time(now, interval=DAEMON_INTERVAL, offset=DAEMON_OFFSET):
+    """First `offset`-shifted multiple of `interval` strictly after `now` (epoch seconds)."""
+    return ((now - offset) // interval + 1) * interval + offset
+
+def update_status(**fields):
+    with status_lock:
+        status.update(fields)
+
+def bump_status(field, by=1):
+    with status_lock:
+        status[field] += by
+
+class RunLock:
+    """Non-blocking exclusive lock file; `acquire()` is False while another run holds it."""
+
+    def __init__(self, path=LOCK_FILE):
+        self.path = path
+        self.handle = None
+
+    def acquire(self):
+        if fcntl is None:
+            return True
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.handle = open(self.path, "w")
+        try:
+            fcntl.flock(self.handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.handle.close()
+            self.handle = None
+            return False
+        self.handle.write(str(os.getpid()))
+        self.handle.flush()
+        return True
+
+    def release(self):
+        if self.handle is not None:
+            fcntl.flock(self.handle, fcntl.LOCK_UN)
+            self.handle.close()
+            self.handle = None
+
+class StatusHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        with status_lock:
+            body = dict(status)
+        if self.path.startswith("/health"):
+            last = body["last_cycle"]
+            healthy = last is None or last["ok"]
+            code, body = (200 if healthy else 503), {"healthy": healthy, "state": body["state"]}
+        elif self.path.startswith("/status"):
+            code = 200
+        else:
+            code, body = 404, {"error": "try /health or /status"}
+        payload = json.dumps(body, default=str).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass  # keep the pipeline log readable
+
+def start_status_server(host=STATUS_HOST, port=STATUS_PORT):
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), StatusHandler)
+    threading.Thread(target=server.serve_forever, name="status", daemon=True).start()
+    print(f"🩺 Status endpoint on http://{host}:{server.server_port}/status")
+    return server
+
+def warm_up():
+    """Pays the one-off costs (plotting import, API clients) before the first cycle."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot  # noqa: F401  (chart workers fork with it already loaded)
+
+    if LOAD_BACKEND == "supabase":
+        from clients import get_rest_session, get_supabase
+        from load import LOAD_CONCURRENCY
+        get_supabase()
+        get_rest_session(LOAD_CONCURRENCY)
+
+def run_cycle(session, stream, compact, stop, lock):
+    """One scheduled cycle with retries; returns the record shown on /status."""
+    if not lock.acquire():
+        print("⏭️  Another pipeline run holds the lock, skipping this cycle.")
+        bump_status("skipped")
+        return None
+
+    cycle = {"started": datetime.now().isoformat(timespec="seconds"), "attempts": 0, "ok": False}
+    try:
+        for attempt in range(DAEMON_MAX_RETRIES + 1):
+            cycle["attempts"] = attempt + 1
+            try:
+                run_full_pipeline(stream=stream, compact=compact, session=session)
+                cycle["ok"], cycle["error"] = True, None
+                break
+            except Exception as e:
+                # PipelineError and friends are retried; SystemExit (bad config) stops the daemon
+                cycle["error"] = repr(e)
+                if attempt == DAEMON_MAX_RETRIES:
+                    print(f"❌ Cycle failed after {attempt + 1} attempts: {e}")
+                    break
+                delay = backoff_delay(attempt, RETRY_BASE, RETRY_CAP)
+                print(f"⚠️ Cycle attempt {attempt + 1} failed ({e}), retrying in {delay:.0f}s...")
+                update_status(state="retrying")
+                if stop.wait(delay):
+                    break
+    finally:
+        lock.release()
+
+    cycle["finished"] = datetime.now().isoformat(timespec="seconds")
+    cycle["summary"] = instrumentation.run_summary()
+    bump_status("cycles")
+    bump_status("failures", 0 if cycle["ok"] else 1)
+    update_status(last_cycle=cycle)
+    return cycle
+
+def run_daemon(stream=STREAM_PIPELINE, compact=COMPACT_AFTER_RUN, run_now=True):
+    """
+    Runs pipeline cycles on the update cadence until SIGINT/SIGTERM, keeping
+    imports, API clients and the HTTP connection pool warm between cycles.
+    """
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+
+    print("===================================================")
+    print(f"🛰️  ATMOSTRACK DAEMON (every {DAEMON_INTERVAL}s, +{DAEMON_OFFSET}s offset)")
+    print("===================================================")
+    server = start_status_server()
+    warm_up()
+    lock = RunLock()
+    session = create_session(MAX_WORKERS)
+
+    try:
+        due = time.time() if run_now else next_run_time(time.time())
+        while not stop.is_set():
+            update_status(state="sleeping", next_run=datetime.fromtimestamp(due).isoformat(timespec="seconds"))
+            if stop.wait(max(0.0, due - time.time())):
+                break
+            update_status(state="running")
+            run_cycle(session, stream, compact, stop, lock)
+            # A cycle that overran its slot just moves on to the next one
+            due = next_run_time(time.time())
+    finally:
+        session.close()
+        if server:
+            server.shutdown()
+        update_status(state="stopped")
+        print("👋 Daemon stopped.")
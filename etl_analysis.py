@@ -63,12 +63,17 @@ if __name__ == "__main__":
 
 # etl_analysis.py
 import os
+import json
+import hashlib
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
-from supabase import create_client
 from pathlib import Path
+from clients import get_supabase
+from rollups import load_rollups, build_rollups, rollup_kpis
+from instrumentation import stage
+from schema import apply_schema
 
 load_dotenv()
 
@@ -76,60 +81,333 @@ BASE_DIR = Path(__file__).resolve().parents[0]
 PROCESSED_DIR = BASE_DIR / "data" / "processed"
 PROCESSED_DIR.mkdir(parents=True, exist_ok=True)
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 TABLE_NAME = "air_quality_data"
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Query engine: supabase (views over REST), postgres (SQL over DATABASE_URL) or
+# duckdb (local store); follows LOAD_BACKEND by default
+LOAD_BACKEND = os.getenv("LOAD_BACKEND", "supabase").lower()
+SQL_BACKENDS = ("postgres", "duckdb")  # queried directly, see sql_analysis.py
+ANALYSIS_BACKEND = os.getenv(
+    "ANALYSIS_BACKEND", LOAD_BACKEND if LOAD_BACKEND in SQL_BACKENDS else "supabase"
+).lower()
 
-def run_analysis():
-    print(f"🔍 Fetching data from '{TABLE_NAME}'...")
-    
-    # Fetch all data (adjust limit if dataset grows huge)
-    res = supabase.table(TABLE_NAME).select("*").limit(5000).execute()
-    
-    if not res.data:
-        print("⚠️ No data found in database.")
-        return
+PAGE_SIZE = 1000  # PostgREST default max rows per response
 
-    df = pd.DataFrame(res.data)
-    
-    # Ensure numeric types
-    numeric_cols = ["pm2_5", "pm10", "ozone", "severity_score", "hour"]
-    for col in numeric_cols:
-        if col in df.columns:
-            df[col] = pd.to_numeric(df[col], errors="coerce")
+# Read KPIs from the local rollup store kept up to date by each load
+USE_ROLLUPS = os.getenv("ANALYSIS_ROLLUPS", "1") == "1"
 
-    print("📊 Performing Analytics...")
+# Columns needed for the trend report and scatter plot (never select *)
+RAW_COLUMNS = ["id", "city", "time", "hour", "pm2_5", "pm10", "ozone", "severity_score", "risk_flag"]
+
+# Trend report / scatter window: the last N days up to the latest row
+TREND_DAYS = int(os.getenv("ANALYSIS_TREND_DAYS", "7"))
+
+# Chart rendering: worker processes (1 = in-process) and aggregate sizes
+CHART_WORKERS = int(os.getenv("CHART_WORKERS", "4"))
+HIST_BINS = 30
+SCATTER_MAX_POINTS = 5000  # deterministic sample above this
+CHART_CACHE_FILE = ".chart_cache.json"  # PNG name -> hash of the aggregate it was drawn from
+CHART_VERSION = "1"  # bump when chart code changes so cached PNGs are redrawn
+
+# Chart aggregates, shared by the Supabase views and the SQL backends ({table} is filled in per engine)
+CHART_QUERIES = {
+    "hour_city_stats": """
+        SELECT city, hour, AVG(pm2_5) AS avg_pm25
+        FROM {table} WHERE city IS NOT NULL AND hour IS NOT NULL GROUP BY city, hour
+    """,
+    # Equal-width bins between the min and max reading, like np.histogram
+    "pm25_hist": f"""
+        WITH bounds AS (SELECT MIN(pm2_5) AS lo, MAX(pm2_5) AS hi FROM {{table}} WHERE pm2_5 IS NOT NULL)
+        SELECT bin, MIN(lo) AS lo, MIN(hi) AS hi, COUNT(*) AS n
+        FROM (
+            SELECT COALESCE(LEAST(CAST(FLOOR((pm2_5 - lo) / NULLIF(hi - lo, 0) * {HIST_BINS}) AS INTEGER),
+                                  {HIST_BINS - 1}), 0) AS bin, lo, hi
+            FROM {{table}}, bounds WHERE pm2_5 IS NOT NULL
+        ) binned
+        GROUP BY bin
+    """,
+}
+
+# Server-side aggregates: their size depends on cities x hours, not on rows
+ANALYSIS_VIEWS_SQL = f"""
+CREATE OR REPLACE VIEW public.{TABLE_NAME}_city_stats AS
+SELECT city, AVG(pm2_5) AS avg_pm25, MAX(severity_score) AS max_severity, COUNT(*) AS n_rows
+FROM public.{TABLE_NAME} WHERE city IS NOT NULL GROUP BY city;
+
+CREATE OR REPLACE VIEW public.{TABLE_NAME}_hour_stats AS
+SELECT hour, AVG(pm2_5) AS avg_pm25
+FROM public.{TABLE_NAME} WHERE hour IS NOT NULL GROUP BY hour;
+
+CREATE OR REPLACE VIEW public.{TABLE_NAME}_risk_dist AS
+SELECT city, risk_flag, COUNT(*) AS n
+FROM public.{TABLE_NAME} WHERE city IS NOT NULL AND risk_flag IS NOT NULL GROUP BY city, risk_flag;
+
+CREATE OR REPLACE VIEW public.{TABLE_NAME}_hour_city_stats AS
+{CHART_QUERIES["hour_city_stats"].format(table=f"public.{TABLE_NAME}").strip()};
+
+CREATE OR REPLACE VIEW public.{TABLE_NAME}_pm25_hist AS
+{CHART_QUERIES["pm25_hist"].format(table=f"public.{TABLE_NAME}").strip()};
+
+CREATE INDEX IF NOT EXISTS {TABLE_NAME}_severity_idx ON public.{TABLE_NAME} (severity_score DESC NULLS LAST);
+CREATE INDEX IF NOT EXISTS {TABLE_NAME}_time_idx ON public.{TABLE_NAME} (time);
+"""
+
+def create_analysis_views():
+    try:
+        print("🔧 Creating analysis views...")
+        get_supabase().rpc("execute_sql", {"query": ANALYSIS_VIEWS_SQL}).execute()
+        print("✅ Analysis views ready.")
+    except Exception as e:
+        print(f"⚠️ RPC Error: {e}")
+        print("ℹ️  Please run the SQL manually in Supabase Dashboard.")
+        print(ANALYSIS_VIEWS_SQL)
+
+def fetch_view(name, columns, order):
+    """Reads a (small) aggregate view page by page."""
+    rows, start = [], 0
+    while True:
+        query = get_supabase().table(name).select(columns)
+        for col in order:
+            query = query.order(col)
+        page = query.range(start, start + PAGE_SIZE - 1).execute().data
+        rows.extend(page)
+        if len(page) < PAGE_SIZE:
+            return pd.DataFrame(rows, columns=columns.split(","))
+        start += PAGE_SIZE
+
+def fetch_rows(columns=RAW_COLUMNS, days=None, page_size=PAGE_SIZE):
+    """
+    Keyset-paginated fetch of selected columns (id > last id), limited to the
+    last `days` days up to the latest row (every row when None).
+    """
+    if ANALYSIS_BACKEND in SQL_BACKENDS:
+        from sql_analysis import query_rows
+        return query_rows(ANALYSIS_BACKEND, columns, days)
+
+    since = None
+    if days:
+        latest = (
+            get_supabase().table(TABLE_NAME).select("time")
+            .order("time", desc=True, nullsfirst=False).limit(1).execute().data
+        )
+        if not latest:
+            return apply_schema(pd.DataFrame(columns=columns))
+        since = (pd.Timestamp(latest[0]["time"]) - pd.Timedelta(days=days)).isoformat()
+
+    rows, last_id = [], 0
+    while True:
+        query = get_supabase().table(TABLE_NAME).select(",".join(columns)).gt("id", last_id)
+        if since:
+            query = query.gte("time", since)
+        page = query.order("id").limit(page_size).execute().data
+        rows.extend(page)
+        if len(page) < page_size:
+            return apply_schema(pd.DataFrame(rows, columns=columns))
+        last_id = page[-1]["id"]
+
+def fetch_aggregates():
+    """Per-city, per-hour and city x risk aggregates plus the top severity event."""
+    if ANALYSIS_BACKEND in SQL_BACKENDS:
+        from sql_analysis import query_aggregates
+        return query_aggregates(ANALYSIS_BACKEND)
+
+    city_stats = fetch_view(f"{TABLE_NAME}_city_stats", "city,avg_pm25,max_severity,n_rows", ["city"])
+    hour_stats = fetch_view(f"{TABLE_NAME}_hour_stats", "hour,avg_pm25", ["hour"])
+    risk_rows = fetch_view(f"{TABLE_NAME}_risk_dist", "city,risk_flag,n", ["city", "risk_flag"])
+    top_event = (
+        get_supabase().table(TABLE_NAME).select("city,severity_score")
+        .order("severity_score", desc=True, nullsfirst=False).limit(1).execute().data
+    )
+    return city_stats, hour_stats, risk_rows, top_event
+
+def fetch_chart_aggregates():
+    """Hourly PM2.5 means per city and PM2.5 histogram bins, computed by the database."""
+    if ANALYSIS_BACKEND in SQL_BACKENDS:
+        from sql_analysis import query_frames
+        frames = query_frames(ANALYSIS_BACKEND, CHART_QUERIES)
+    else:
+        frames = {
+            "hour_city_stats": fetch_view(f"{TABLE_NAME}_hour_city_stats", "city,hour,avg_pm25", ["city", "hour"]),
+            "pm25_hist": fetch_view(f"{TABLE_NAME}_pm25_hist", "bin,lo,hi,n", ["bin"]),
+        }
+    return frames["hour_city_stats"], frames["pm25_hist"]
+
+def fetch_kpis():
+    """KPI metrics and the city x risk distribution, computed by the database."""
+    city_stats, hour_stats, risk_rows, top_event = fetch_aggregates()
+    if city_stats.empty or not top_event:
+        return None, None
 
-    # --- A. KPI Metrics ---
     metrics = {}
-    
+
     # 1. City with highest average PM2.5
-    avg_pm25 = df.groupby("city")["pm2_5"].mean()
+    avg_pm25 = pd.to_numeric(city_stats.set_index("city")["avg_pm25"], errors="coerce")
     metrics["Worst City (Avg PM2.5)"] = avg_pm25.idxmax()
     metrics["Worst City PM2.5 Value"] = avg_pm25.max()
-    
+
     # 2. City with highest severity score (Max single event)
-    max_sev_idx = df["severity_score"].idxmax()
-    metrics["Highest Severity Event City"] = df.loc[max_sev_idx, "city"]
-    metrics["Highest Severity Score"] = df.loc[max_sev_idx, "severity_score"]
-    
+    metrics["Highest Severity Event City"] = top_event[0]["city"]
+    metrics["Highest Severity Score"] = top_event[0]["severity_score"]
+
     # 3. Hour of day with worst AQI (Avg PM2.5)
-    worst_hour = df.groupby("hour")["pm2_5"].mean().idxmax()
-    metrics["Worst Hour of Day"] = worst_hour
-    
+    hourly = pd.to_numeric(hour_stats.set_index("hour")["avg_pm25"], errors="coerce")
+    metrics["Worst Hour of Day"] = hourly.idxmax()
+
     # 4. Risk Percentages (Global)
-    risk_counts = df["risk_flag"].value_counts(normalize=True) * 100
+    risk_dist = risk_rows.pivot(index="city", columns="risk_flag", values="n").fillna(0).astype(int)
+    risk_counts = risk_dist.sum() / risk_dist.values.sum() * 100
     metrics["High Risk %"] = risk_counts.get("High Risk", 0)
     metrics["Moderate Risk %"] = risk_counts.get("Moderate Risk", 0)
-    
+
+    return metrics, risk_dist
+
+def histogram_bins(bins):
+    """Database bin counts -> every bin's edges and count (empty bins included)."""
+    if bins.empty:
+        return pd.DataFrame({"left": [], "right": [], "count": []})
+    lo, hi = float(bins["lo"].iloc[0]), float(bins["hi"].iloc[0])
+    if lo == hi:
+        lo, hi = lo - 0.5, hi + 0.5  # np.histogram's range for a single value
+    edges = np.linspace(lo, hi, HIST_BINS + 1)
+    counts = bins.set_index(bins["bin"].astype(int))["n"].astype(int).reindex(range(HIST_BINS), fill_value=0)
+    return pd.DataFrame({"left": edges[:-1], "right": edges[1:], "count": counts.to_numpy()})
+
+def chart_inputs(df, hour_city, bins, risk_dist):
+    """
+    Everything the charts draw, pre-aggregated: the database computes the
+    hourly means and histogram bins, `df` only holds the trend window.
+    """
+    hour_city = hour_city.assign(avg_pm25=pd.to_numeric(hour_city["avg_pm25"], errors="coerce"))
+    hourly = hour_city.pivot(index="hour", columns="city", values="avg_pm25").sort_index()
+    scatter = df[["pm2_5", "severity_score", "risk_flag"]].dropna()
+    if len(scatter) > SCATTER_MAX_POINTS:
+        scatter = scatter.sample(SCATTER_MAX_POINTS, random_state=0)
+    return {
+        "pm25_histogram.png": histogram_bins(bins),
+        "city_risk_bar.png": risk_dist,
+        "hourly_pm25_trend.png": hourly,
+        "severity_scatter.png": scatter.sort_index(),
+    }
+
+def input_hash(name, data):
+    digest = hashlib.sha256(f"{CHART_VERSION}|{name}".encode())
+    digest.update(pd.util.hash_pandas_object(data.reset_index(), index=False).values.tobytes())
+    digest.update(",".join(map(str, data.columns)).encode())
+    return digest.hexdigest()
+
+def draw_chart(name, data, path):
+    """Draws one PNG from its aggregate (runs in a worker process)."""
+    import matplotlib
+    matplotlib.use("Agg")  # No display needed, safe in worker processes
+    import matplotlib.pyplot as plt
+
+    if name == "pm25_histogram.png":
+        # 1. Histogram of PM2.5
+        plt.figure(figsize=(8, 5))
+        if not data.empty:
+            plt.stairs(data["count"], np.append(data["left"].values, data["right"].values[-1:]),
+                       fill=True, color="purple", alpha=0.6)
+        plt.title("Distribution of PM2.5 Concentration")
+        plt.xlabel("PM2.5 (µg/m³)")
+        plt.ylabel("Count")
+    elif name == "city_risk_bar.png":
+        # 2. Bar chart of risk flags per city
+        data.plot(kind="bar", stacked=True, colormap="viridis", figsize=(10, 6))
+        plt.title("Risk Level Distribution by City")
+        plt.ylabel("Count of Hours")
+        plt.xticks(rotation=45)
+        plt.tight_layout()
+    elif name == "hourly_pm25_trend.png":
+        # 3. Line chart of hourly PM2.5 trends (Average across all days per hour)
+        data.plot(figsize=(10, 5), marker="o")
+        plt.title("Hourly Average PM2.5 Trends")
+        plt.ylabel("PM2.5 (µg/m³)")
+        plt.xlabel("Hour of Day (0-23)")
+        plt.grid(True, linestyle="--", alpha=0.5)
+    elif name == "severity_scatter.png":
+        # 4. Scatter: Severity Score vs PM2.5
+        plt.figure(figsize=(8, 5))
+        for flag, group in data.groupby("risk_flag"):
+            plt.scatter(group["pm2_5"], group["severity_score"], label=flag, alpha=0.7, s=12)
+        plt.legend(title="risk_flag")
+        plt.title("Severity Score vs PM2.5")
+        plt.grid(True)
+    plt.savefig(path)
+    plt.close("all")
+    return name
+
+def render_charts(df, hour_city, bins, risk_dist, workers=CHART_WORKERS):
+    """Draws the report PNGs in worker processes, skipping any whose inputs are unchanged."""
+    cache_file = PROCESSED_DIR / CHART_CACHE_FILE
+    cache = json.loads(cache_file.read_text()) if cache_file.exists() else {}
+
+    inputs = chart_inputs(df, hour_city, bins, risk_dist)
+    hashes = {name: input_hash(name, data) for name, data in inputs.items()}
+    stale = [
+        name for name in inputs
+        if cache.get(name) != hashes[name] or not (PROCESSED_DIR / name).exists()
+    ]
+    if not stale:
+        print("✅ All plots up to date (inputs unchanged).")
+        return
+
+    if workers > 1 and len(stale) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(stale))) as pool:
+            list(pool.map(draw_chart, stale, [inputs[n] for n in stale], [PROCESSED_DIR / n for n in stale]))
+    else:
+        for name in stale:
+            draw_chart(name, inputs[name], PROCESSED_DIR / name)
+
+    cache.update({name: hashes[name] for name in stale})
+    cache_file.write_text(json.dumps(cache, indent=2))
+    print(f"✅ Plots generated ({len(stale)} rendered, {len(inputs) - len(stale)} unchanged).")
+
+def run_analysis():
+    with stage("analysis", backend=ANALYSIS_BACKEND) as metrics:
+        metrics["rows"] = analyze()
+
+def analyze():
+    """KPIs, trend report and charts; returns the number of rows pulled for the trend window."""
+    rollups = load_rollups() if USE_ROLLUPS else None
+
+    with stage("analysis.kpis", source="rollups" if rollups else ANALYSIS_BACKEND):
+        if rollups:
+            print("🧮 Reading KPIs from rollups...")
+            metrics, risk_dist = rollup_kpis(rollups)
+        else:
+            print(f"🔍 Aggregating '{TABLE_NAME}' in {ANALYSIS_BACKEND}...")
+            try:
+                metrics, risk_dist = fetch_kpis()
+            except Exception as e:
+                if ANALYSIS_BACKEND != "supabase":
+                    raise
+                print(f"⚠️ Aggregate views unavailable ({e}).")
+                create_analysis_views()
+                metrics, risk_dist = fetch_kpis()
+
+    if metrics is None:
+        print("⚠️ No data found in database.")
+        return 0
+
+    print("📊 Performing Analytics...")
+
+    # --- A. KPI Metrics ---
     # Save Metrics Summary
     metrics_df = pd.DataFrame([metrics])
     metrics_df.to_csv(PROCESSED_DIR / "summary_metrics.csv", index=False)
     print(f"✅ Metrics saved to {PROCESSED_DIR / 'summary_metrics.csv'}")
 
+    # First run only: bootstrap the rollups from the table, later loads keep them current
+    if USE_ROLLUPS and rollups is None:
+        print(f"🧮 Bootstrapping rollups from '{TABLE_NAME}' (one-off)...")
+        build_rollups(fetch_rows())
+
     # --- B. City Pollution Trend Report ---
+    print(f"🔍 Fetching the last {TREND_DAYS} days of trend columns from '{TABLE_NAME}' ({ANALYSIS_BACKEND})...")
+    with stage("analysis.fetch_rows", days=TREND_DAYS) as fetched:
+        df = fetch_rows(days=TREND_DAYS)
+        fetched["rows"] = len(df)
+
     # Filter columns
     trend_cols = ["city", "time", "pm2_5", "pm10", "ozone"]
     trend_df = df[[c for c in trend_cols if c in df.columns]]
@@ -137,49 +415,21 @@ def run_analysis():
     print(f"✅ Trends saved to {PROCESSED_DIR / 'pollution_trends.csv'}")
 
     # --- C. Export Outputs (Risk Distribution) ---
-    risk_dist = df.groupby(["city", "risk_flag"]).size().unstack(fill_value=0)
     risk_dist.to_csv(PROCESSED_DIR / "city_risk_distribution.csv")
     print(f"✅ Risk dist saved to {PROCESSED_DIR / 'city_risk_distribution.csv'}")
 
     # --- D. Visualizations ---
-    
-    # 1. Histogram of PM2.5
-    plt.figure(figsize=(8, 5))
-    sns.histplot(df["pm2_5"], bins=30, kde=True, color="purple")
-    plt.title("Distribution of PM2.5 Concentration")
-    plt.xlabel("PM2.5 (µg/m³)")
-    plt.savefig(PROCESSED_DIR / "pm25_histogram.png")
-    plt.close()
-
-    # 2. Bar chart of risk flags per city
-    plt.figure(figsize=(10, 6))
-    risk_dist.plot(kind="bar", stacked=True, colormap="viridis", figsize=(10, 6))
-    plt.title("Risk Level Distribution by City")
-    plt.ylabel("Count of Hours")
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.savefig(PROCESSED_DIR / "city_risk_bar.png")
-    plt.close()
-
-    # 3. Line chart of hourly PM2.5 trends (Average across all days per hour)
-    plt.figure(figsize=(10, 5))
-    sns.lineplot(data=df, x="hour", y="pm2_5", hue="city", marker="o")
-    plt.title("Hourly Average PM2.5 Trends")
-    plt.ylabel("PM2.5 (µg/m³)")
-    plt.xlabel("Hour of Day (0-23)")
-    plt.grid(True, linestyle="--", alpha=0.5)
-    plt.savefig(PROCESSED_DIR / "hourly_pm25_trend.png")
-    plt.close()
-
-    # 4. Scatter: Severity Score vs PM2.5
-    plt.figure(figsize=(8, 5))
-    sns.scatterplot(data=df, x="pm2_5", y="severity_score", hue="risk_flag", alpha=0.7)
-    plt.title("Severity Score vs PM2.5")
-    plt.grid(True)
-    plt.savefig(PROCESSED_DIR / "severity_scatter.png")
-    plt.close()
-    
-    print("✅ All plots generated.")
+    with stage("analysis.charts"):
+        try:
+            hour_city, bins = fetch_chart_aggregates()
+        except Exception as e:
+            if ANALYSIS_BACKEND != "supabase":
+                raise
+            print(f"⚠️ Chart views unavailable ({e}).")
+            create_analysis_views()
+            hour_city, bins = fetch_chart_aggregates()
+        render_charts(df, hour_city, bins, risk_dist)
+    return len(df)
 
 if __name__ == "__main__":
     run_analysis()
\ No newline at end of file
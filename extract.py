@@ -1,15 +1,33 @@
-import json
+import os
 import time
+import threading
 import requests
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+from watermark import FORECAST_DAYS, load_watermarks, record_utc_offsets
+from jsonio import loads, write_json
+from instrumentation import stage, observe_request
+from http_cache import cached_get
 
 BASE_DIR = Path(__file__).resolve().parents[0]
 RAW_DIR = BASE_DIR / "data" / "raw"
 RAW_DIR.mkdir(parents=True, exist_ok=True)
 
 # Open-Meteo API Endpoint (No Key Required)
-API_URL = "https://air-quality-api.open-meteo.com/v1/air-quality"
+API_URL = os.getenv("OPEN_METEO_URL", "https://air-quality-api.open-meteo.com/v1/air-quality")
+
+# Concurrency settings (override via .env / environment)
+MAX_WORKERS = int(os.getenv("EXTRACT_MAX_WORKERS", "8"))
+RATE_LIMIT = float(os.getenv("EXTRACT_RATE_LIMIT", "5"))  # requests per second, 0 = unlimited
+BATCH_SIZE = int(os.getenv("EXTRACT_BATCH_SIZE", "50"))  # locations per request, 1 = per-city
+
+# Opt-in: grid spacing in degrees of the model serving these locations. Locations
+# snapping to the same grid point get identical data, so each cell is fetched once.
+# Off by default (0): the API serves these cities on a 0.1° or finer grid, so a
+# coarser setting would hand one city another city's readings.
+GRID_RESOLUTION = float(os.getenv("EXTRACT_GRID_RESOLUTION", "0"))
 
 # City Coordinates for India
 CITIES = {
@@ -22,37 +40,202 @@ CITIES = {
 
 METRICS = "pm10,pm2_5,carbon_monoxide,nitrogen_dioxide,ozone,sulphur_dioxide,uv_index"
 
-def fetch_data(city, lat, lon):
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` requests per second."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def create_session(pool_size=MAX_WORKERS):
+    """Shared keep-alive session sized for the worker pool."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def grid_cell(lat, lon, resolution=GRID_RESOLUTION):
+    """Nearest model grid point for a coordinate (the coordinate itself if resolution is 0)."""
+    if resolution <= 0:
+        return lat, lon
+    return round(round(lat / resolution) * resolution, 4), round(round(lon / resolution) * resolution, 4)
+
+def request_window(watermark):
+    """Date window covering only hours after `watermark` (empty = full default window)."""
+    if watermark is None:
+        return {}
+    start = (watermark + timedelta(hours=1)).date()
+    end = datetime.now().date() + timedelta(days=FORECAST_DAYS - 1)
+    if start > end:
+        return {}
+    return {"start_date": start.isoformat(), "end_date": end.isoformat()}
+
+def fetch_data(city, lat, lon, session=None, window=None):
     params = {
         "latitude": lat, "longitude": lon,
-        "hourly": METRICS, "timezone": "auto"
+        "hourly": METRICS, "timezone": "auto",
+        **(window or {})
     }
+    http = session or requests
+    started = time.perf_counter()
     try:
         print(f"⏳ Fetching data for {city}...")
-        resp = requests.get(API_URL, params=params, timeout=10)
-        resp.raise_for_status()
-        data = resp.json()
+        # Served from the on-disk cache while fresh (or revalidated with ETag/Last-Modified)
+        content, source = cached_get(http, API_URL, params, timeout=10)
+        if source == "hit":
+            print(f"♻️  Cached response reused for {city}")
+        else:
+            observe_request("fetch_data", time.perf_counter() - started)
+        data = loads(content)
         data["city_name"] = city  # Tag the data with city name
         return data
     except Exception as e:
+        observe_request("fetch_data", time.perf_counter() - started, ok=False)
         print(f"⚠️ Error fetching {city}: {e}")
         return None
 
-def extract_atmos_data():
+def fetch_batch(cities, session=None, window=None):
+    """Fetches several cities in one request using comma-separated coordinates."""
+    names = list(cities)
+    params = {
+        "latitude": ",".join(str(cities[c]["lat"]) for c in names),
+        "longitude": ",".join(str(cities[c]["lon"]) for c in names),
+        "hourly": METRICS, "timezone": "auto",
+        **(window or {})
+    }
+    http = session or requests
+    print(f"⏳ Fetching batch of {len(names)} cities...")
+    started = time.perf_counter()
+    try:
+        content, source = cached_get(http, API_URL, params, timeout=30)
+    except Exception:
+        observe_request("fetch_batch", time.perf_counter() - started, ok=False)
+        raise
+    if source == "hit":
+        print(f"♻️  Cached response reused for batch of {len(names)} cities")
+    else:
+        observe_request("fetch_batch", time.perf_counter() - started)
+    data = loads(content)
+
+    # A single location comes back as an object, several as a list (same order as requested)
+    if isinstance(data, dict):
+        data = [data]
+    if len(data) != len(names):
+        raise ValueError(f"Expected {len(names)} locations, got {len(data)}")
+
+    for city, payload in zip(names, data):
+        payload["city_name"] = city
+    return dict(zip(names, data))
+
+def save_raw(city, data, timestamp):
+    filename = write_json(RAW_DIR / f"{city.lower()}_raw_{timestamp}.json", data)
+    print(f"✅ Saved: {filename}")
+    return str(filename)
+
+def extract_atmos_data(max_workers=MAX_WORKERS, rate_limit=RATE_LIMIT, batch_size=BATCH_SIZE, on_file=None,
+                       grid_resolution=GRID_RESOLUTION, session=None):
+    """
+    Fetches every city and returns the saved raw file paths in CITIES order.
+    `on_file(path)` is called as soon as each file is written (streaming pipeline hook).
+    Pass a long-lived `session` to keep its connections warm across runs.
+    """
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    saved_files = []
+    bucket = TokenBucket(rate_limit)
 
-    print("🚀 Starting Extraction...")
+    # Cities in the same grid cell share one request; the first one stands in for the cell
+    cells = {}
     for city, coords in CITIES.items():
-        data = fetch_data(city, coords["lat"], coords["lon"])
-        if data:
-            filename = RAW_DIR / f"{city.lower()}_raw_{timestamp}.json"
-            filename.write_text(json.dumps(data, indent=2))
-            saved_files.append(str(filename))
-            print(f"✅ Saved: {filename}")
-        time.sleep(1)
-    
-    return saved_files
+        cells.setdefault(grid_cell(coords["lat"], coords["lon"], grid_resolution), []).append(city)
+    members = {cities[0]: cities for cities in cells.values()}
+    offsets = {}
+
+    def save(cell, data):
+        # Same payload for every member, re-tagged with each city's name
+        saved = []
+        for city in members[cell]:
+            offsets[city] = data.get("utc_offset_seconds")
+            data["city_name"] = city
+            path = save_raw(city, data, timestamp)
+            if on_file:
+                on_file(path)
+            saved.append((city, path))
+        return saved
+
+    watermarks = load_watermarks()
+
+    def fetch_city(cell, coords, window):
+        bucket.acquire()
+        data = fetch_data(cell, coords["lat"], coords["lon"], session=session, window=window)
+        return save(cell, data) if data else []
+
+    def fetch_chunk(job):
+        window, chunk = job
+        if len(chunk) == 1:
+            return [pair for cell, coords in chunk.items() for pair in fetch_city(cell, coords, window)]
+        bucket.acquire()
+        try:
+            payloads = fetch_batch(chunk, session=session, window=window)
+        except Exception as e:
+            # Fall back to one request per city so a bad batch doesn't lose every city
+            print(f"⚠️ Batch failed ({e}), retrying {len(chunk)} cities individually...")
+            return [pair for cell, coords in chunk.items() for pair in fetch_city(cell, coords, window)]
+        return [pair for cell, data in payloads.items() for pair in save(cell, data)]
+
+    # Cells sharing the same incremental window can share a batched request; a cell's
+    # window reaches back to its member with the oldest watermark
+    groups = {}
+    for cell, cities in members.items():
+        marks = [watermarks.get(city) for city in cities]
+        window = request_window(None if None in marks else min(marks))
+        groups.setdefault(tuple(window.items()), []).append((cell, CITIES[cell]))
+
+    size = max(1, batch_size)
+    jobs = [
+        (dict(key), dict(items[i:i + size]))
+        for key, items in groups.items()
+        for i in range(0, len(items), size)
+    ]
+
+    if len(members) < len(CITIES):
+        print(f"🧭 {len(CITIES)} locations map to {len(members)} grid cells ({grid_resolution}°)")
+    print(f"🚀 Starting Extraction ({len(jobs)} requests, {max_workers} workers, {rate_limit or 'unlimited'} req/s)...")
+    with stage("extract", requests=len(jobs), cells=len(members)) as metrics:
+        own_session = session is None
+        if own_session:
+            session = create_session(max_workers)
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+                saved = dict(pair for result in pool.map(fetch_chunk, jobs) for pair in result)
+        finally:
+            if own_session:
+                session.close()
+
+        # Watermarks stop at each city's current local hour (see update_watermarks)
+        record_utc_offsets(offsets)
+
+        # Return files in CITIES order so the list is stable across runs
+        files = [saved[city] for city in CITIES if saved.get(city)]
+        metrics["files"] = len(files)
+        metrics["bytes"] = sum(Path(path).stat().st_size for path in files)
+    return files
 
 if __name__ == "__main__":
     extract_atmos_data()
\ No newline at end of file
@@ -0,0 +1,105 @@
+# http_cache.py
+import os
+import json
+import time
+import hashlib
+import threading
+from pathlib import Path
+from jsonio import write_atomic, write_json_atomic
+
+BASE_DIR = Path(__file__).resolve().parents[0]
+
+# On-disk response cache for API GETs (override via .env / environment)
+HTTP_CACHE_ENABLED = os.getenv("HTTP_CACHE", "1") == "1"
+HTTP_CACHE_DIR = Path(os.getenv("HTTP_CACHE_DIR", BASE_DIR / "data" / "cache" / "http"))
+HTTP_CACHE_TTL = float(os.getenv("HTTP_CACHE_TTL", "3600"))  # seconds a response is served without asking
+HTTP_CACHE_MAX_MB = float(os.getenv("HTTP_CACHE_MAX_MB", "200"))  # size cap, least recently used evicted first
+
+_lock = threading.Lock()
+
+def cache_key(url, params):
+    """Stable key over the URL and every query parameter (coordinates, metrics, window...)."""
+    blob = json.dumps([url, sorted((k, str(v)) for k, v in params.items())])
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+def entry_paths(key):
+    return HTTP_CACHE_DIR / f"{key}.body", HTTP_CACHE_DIR / f"{key}.meta.json"
+
+def read_entry(key):
+    body_path, meta_path = entry_paths(key)
+    try:
+        return json.loads(meta_path.read_text()), body_path.read_bytes()
+    except (OSError, ValueError):
+        return None, None
+
+def write_entry(key, url, params, body, headers):
+    HTTP_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    body_path, meta_path = entry_paths(key)
+    meta = {
+        "url": url,
+        "params": {k: str(v) for k, v in params.items()},
+        "stored_at": time.time(),
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "size": len(body),
+    }
+    # Body first, then metadata: a reader never sees metadata for a half-written body
+    write_atomic(body_path, body)
+    touch_meta(meta_path, meta)
+    evict()
+
+def touch_meta(meta_path, meta):
+    write_json_atomic(meta_path, meta)  # new mtime doubles as the "last used" time for eviction
+
+def evict(max_bytes=None):
+    """Drops least recently used entries until the cache fits in HTTP_CACHE_MAX_MB."""
+    max_bytes = HTTP_CACHE_MAX_MB * 1024 * 1024 if max_bytes is None else max_bytes
+    with _lock:
+        entries = []
+        for meta_path in HTTP_CACHE_DIR.glob("*.meta.json"):
+            body_path = meta_path.with_name(meta_path.name.replace(".meta.json", ".body"))
+            try:
+                size = meta_path.stat().st_size + body_path.stat().st_size
+                entries.append((meta_path.stat().st_mtime, size, meta_path, body_path))
+            except OSError:
+                continue
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, meta_path, body_path in sorted(entries):
+            if total <= max_bytes:
+                break
+            meta_path.unlink(missing_ok=True)
+            body_path.unlink(missing_ok=True)
+            total -= size
+
+def cached_get(http, url, params, timeout=10, ttl=HTTP_CACHE_TTL):
+    """
+    GET returning (body bytes, source), where source is "hit" (fresh cache, no
+    request), "revalidated" (304 on ETag/Last-Modified) or "network".
+    """
+    if not HTTP_CACHE_ENABLED:
+        resp = http.get(url, params=params, timeout=timeout)
+        resp.raise_for_status()
+        return resp.content, "network"
+
+    key = cache_key(url, params)
+    meta, body = read_entry(key)
+    _, meta_path = entry_paths(key)
+    if meta is not None and time.time() - meta["stored_at"] < ttl:
+        os.utime(meta_path)
+        return body, "hit"
+
+    headers = {}
+    if meta is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    resp = http.get(url, params=params, timeout=timeout, headers=headers or None)
+    if resp.status_code == 304 and body is not None:
+        meta["stored_at"] = time.time()
+        touch_meta(meta_path, meta)
+        return body, "revalidated"
+    resp.raise_for_status()
+    write_entry(key, url, params, resp.content, resp.headers)
+    return resp.content, "network"
@@ -0,0 +1,46 @@
+# import_budget.py
+import os
+import sys
+import subprocess
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parents[0]
+
+# Startup budget for the CLI (seconds); override via environment on slow CI boxes
+IMPORT_BUDGET = float(os.getenv("IMPORT_BUDGET", "1.5"))
+
+MODULES = ["run_pipeline", "extract", "transform", "load", "etl_analysis"]
+
+# Heavy libraries that must only load when a client/report is actually needed
+LAZY_MODULES = ["supabase", "matplotlib", "seaborn", "duckdb", "psycopg"]
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(",".join(m for m in {lazy!r} if m in sys.modules))
+"""
+
+def measure(module):
+    """Imports `module` in a fresh interpreter; returns (seconds, eagerly loaded heavy modules)."""
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, lazy=LAZY_MODULES)],
+        cwd=BASE_DIR, capture_output=True, text=True, check=True,
+    ).stdout.splitlines()
+    return float(out[0]), [m for m in out[1].split(",") if m]
+
+def check_import_budget(budget=IMPORT_BUDGET):
+    ok = True
+    for module in MODULES:
+        elapsed, eager = measure(module)
+        status = "✅" if elapsed <= budget and not eager else "❌"
+        print(f"{status} import {module}: {elapsed:.2f}s (budget {budget:.2f}s)")
+        if eager:
+            print(f"   ⚠️ Heavy modules imported eagerly: {', '.join(eager)}")
+        ok = ok and status == "✅"
+    return ok
+
+if __name__ == "__main__":
+    sys.exit(0 if check_import_budget() else 1)
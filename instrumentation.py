@@ -0,0 +1,171 @@
+# instrumentation.py
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from jsonio import write_atomic
+
+try:
+    import resource  # Unix only; peak RSS is simply omitted elsewhere
+except ImportError:
+    resource = None
+
+BASE_DIR = Path(__file__).resolve().parents[0]
+METRICS_DIR = BASE_DIR / "data" / "metrics"
+METRICS_DIR.mkdir(parents=True, exist_ok=True)
+
+# Instrumentation settings (override via .env / environment)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_FILE = Path(os.getenv("METRICS_FILE", METRICS_DIR / "pipeline_metrics.jsonl"))
+PROM_TEXTFILE = os.getenv("PROM_TEXTFILE")  # e.g. node_exporter textfile collector path
+
+# Request latency histogram buckets (seconds, Prometheus style: cumulative "le")
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf")]
+
+_lock = threading.Lock()
+_run = {}
+
+def start_run():
+    """Resets the per-run registry; called once per pipeline cycle."""
+    with _lock:
+        _run.clear()
+        _run.update({
+            "run_id": datetime.now().strftime("%Y%m%d_%H%M%S_%f"),
+            "started": time.time(),
+            "stages": {},
+            "requests": {},
+            "retries": {},
+        })
+    return _run["run_id"]
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def emit(record):
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        with open(METRICS_FILE, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+@contextmanager
+def stage(name, **fields):
+    """
+    Times a pipeline stage (wall + CPU) and emits one JSON line when it ends.
+    The yielded dict can be filled with counters such as rows/bytes.
+    """
+    if not _run:
+        start_run()
+    record = {"type": "stage", "run_id": _run["run_id"], "stage": name, **fields}
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield record
+        record["status"] = "ok"
+    except BaseException as e:
+        record["status"] = "error"
+        record["error"] = repr(e)
+        raise
+    finally:
+        record["wall_s"] = round(time.perf_counter() - wall, 4)
+        # Process-wide CPU: overlapping stages (streaming mode) each see the shared total
+        record["cpu_s"] = round(time.process_time() - cpu, 4)
+        record["peak_rss_mb"] = peak_rss_mb()
+        record["ts"] = datetime.now().isoformat(timespec="seconds")
+        if record.get("rows") and record["wall_s"]:
+            record["rows_per_s"] = round(record["rows"] / record["wall_s"], 1)
+        with _lock:
+            _run["stages"].setdefault(name, []).append(record)
+        emit(record)
+
+def observe_request(name, seconds, ok=True):
+    """Adds one HTTP request latency to the `name` histogram."""
+    if not _run:
+        start_run()
+    with _lock:
+        hist = _run["requests"].setdefault(
+            name, {"buckets": [0] * len(LATENCY_BUCKETS), "count": 0, "sum": 0.0, "errors": 0}
+        )
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                hist["buckets"][i] += 1
+        hist["count"] += 1
+        hist["sum"] += seconds
+        hist["errors"] += 0 if ok else 1
+
+def count_retry(name):
+    if not _run:
+        start_run()
+    with _lock:
+        _run["retries"][name] = _run["retries"].get(name, 0) + 1
+
+def run_summary():
+    with _lock:
+        stages = {
+            name: {
+                "wall_s": round(sum(r["wall_s"] for r in records), 4),
+                "cpu_s": round(sum(r["cpu_s"] for r in records), 4),
+                "rows": sum(r.get("rows", 0) or 0 for r in records),
+                "bytes": sum(r.get("bytes", 0) or 0 for r in records),
+                "calls": len(records),
+            }
+            for name, records in _run.get("stages", {}).items()
+        }
+        return {
+            "type": "run",
+            "run_id": _run.get("run_id"),
+            "wall_s": round(time.time() - _run.get("started", time.time()), 4),
+            "peak_rss_mb": peak_rss_mb(),
+            "stages": stages,
+            "requests": json.loads(json.dumps(_run.get("requests", {}))),
+            "retries": dict(_run.get("retries", {})),
+        }
+
+def write_prometheus(summary, path=PROM_TEXTFILE):
+    """Writes the run summary in Prometheus textfile-collector format (atomic replace)."""
+    if not path:
+        return
+    lines = [
+        "# TYPE atmos_stage_wall_seconds gauge",
+        "# TYPE atmos_stage_cpu_seconds gauge",
+        "# TYPE atmos_stage_rows gauge",
+        "# TYPE atmos_stage_bytes gauge",
+    ]
+    for name, s in summary["stages"].items():
+        lines += [
+            f'atmos_stage_wall_seconds{{stage="{name}"}} {s["wall_s"]}',
+            f'atmos_stage_cpu_seconds{{stage="{name}"}} {s["cpu_s"]}',
+            f'atmos_stage_rows{{stage="{name}"}} {s["rows"]}',
+            f'atmos_stage_bytes{{stage="{name}"}} {s["bytes"]}',
+        ]
+    lines.append("# TYPE atmos_request_latency_seconds histogram")
+    for name, h in summary["requests"].items():
+        for bound, count in zip(LATENCY_BUCKETS, h["buckets"]):
+            le = "+Inf" if bound == float("inf") else bound
+            lines.append(f'atmos_request_latency_seconds_bucket{{name="{name}",le="{le}"}} {count}')
+        lines.append(f'atmos_request_latency_seconds_sum{{name="{name}"}} {h["sum"]}')
+        lines.append(f'atmos_request_latency_seconds_count{{name="{name}"}} {h["count"]}')
+    lines.append("# TYPE atmos_retries_total counter")
+    for name, n in summary["retries"].items():
+        lines.append(f'atmos_retries_total{{name="{name}"}} {n}')
+    lines.append("# TYPE atmos_run_wall_seconds gauge")
+    lines.append(f"atmos_run_wall_seconds {summary['wall_s']}")
+    if summary["peak_rss_mb"] is not None:
+        lines.append("# TYPE atmos_peak_rss_megabytes gauge")
+        lines.append(f"atmos_peak_rss_megabytes {summary['peak_rss_mb']}")
+
+    write_atomic(path, "\n".join(lines) + "\n")
+
+def finish_run():
+    """Emits the run summary line (and Prometheus textfile) and returns it."""
+    summary = run_summary()
+    emit(summary)
+    write_prometheus(summary)
+    return summary
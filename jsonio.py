@@ -0,0 +1,104 @@
+# jsonio.py
+import os
+import json
+import gzip
+from pathlib import Path
+
+# Optional fast JSON backends; stdlib json is always the fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Raw file settings (override via .env / environment)
+JSON_BACKEND = os.getenv("JSON_BACKEND", "auto").lower()  # auto | orjson | msgspec | json
+RAW_COMPACT = os.getenv("RAW_COMPACT", "0") == "1"  # drop indentation
+RAW_COMPRESSION = os.getenv("RAW_COMPRESSION", "none").lower()  # none | gzip | zstd
+
+COMPRESSION_SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+def resolve_backend(backend=JSON_BACKEND):
+    if backend == "auto":
+        return "orjson" if orjson else "msgspec" if msgspec else "json"
+    if backend == "orjson" and not orjson:
+        raise ImportError("JSON_BACKEND=orjson but orjson is not installed")
+    if backend == "msgspec" and not msgspec:
+        raise ImportError("JSON_BACKEND=msgspec but msgspec is not installed")
+    return backend
+
+def dumps(data, indent=True, backend=JSON_BACKEND):
+    """Serializes to UTF-8 bytes with the fastest available backend."""
+    backend = resolve_backend(backend)
+    if backend == "orjson":
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 if indent else 0)
+    if backend == "msgspec":
+        raw = msgspec.json.encode(data)
+        return msgspec.json.format(raw, indent=2) if indent else raw
+    if indent:
+        return json.dumps(data, indent=2).encode()
+    return json.dumps(data, separators=(",", ":")).encode()
+
+def loads(raw, backend=JSON_BACKEND):
+    backend = resolve_backend(backend)
+    if backend == "orjson":
+        return orjson.loads(raw)
+    if backend == "msgspec":
+        return msgspec.json.decode(raw)
+    return json.loads(raw)
+
+def compress(raw, compression):
+    if compression == "gzip":
+        return gzip.compress(raw, compresslevel=6)
+    if compression == "zstd":
+        if not zstandard:
+            raise ImportError("RAW_COMPRESSION=zstd but zstandard is not installed")
+        return zstandard.ZstdCompressor(level=3).compress(raw)
+    return raw
+
+def decompress(raw):
+    """Detects gzip/zstd by magic bytes so any stored form reads transparently."""
+    if raw[:2] == GZIP_MAGIC:
+        return gzip.decompress(raw)
+    if raw[:4] == ZSTD_MAGIC:
+        if not zstandard:
+            raise ImportError("zstd-compressed raw file but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(raw)
+    return raw
+
+def write_json(path, data, compact=RAW_COMPACT, compression=RAW_COMPRESSION):
+    """Writes `data` to `path` (+ .gz/.zst suffix when compressed) and returns the final path."""
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError(f"Unknown compression '{compression}', expected one of {list(COMPRESSION_SUFFIXES)}")
+    path = Path(f"{path}{COMPRESSION_SUFFIXES[compression]}")
+    path.write_bytes(compress(dumps(data, indent=not compact), compression))
+    return path
+
+def write_atomic(path, content):
+    """Writes `content` (str or bytes) beside `path`, then swaps it in: a crash never leaves half a file."""
+    path = Path(path)
+    tmp = path.with_suffix(".tmp")
+    if isinstance(content, bytes):
+        tmp.write_bytes(content)
+    else:
+        tmp.write_text(content)
+    tmp.replace(path)
+    return path
+
+def write_json_atomic(path, data, **options):
+    """`data` as stdlib JSON (`options` go to json.dumps), written with `write_atomic`."""
+    return write_atomic(path, json.dumps(data, **options))
+
+def read_json(path):
+    return loads(decompress(Path(path).read_bytes()))
@@ -96,26 +96,63 @@ if __name__ == "__main__":
 
 # load.py
 import os
-import math
+import json
+import time
+import random
+import threading
+import requests
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
 from pathlib import Path
 from dotenv import load_dotenv
-from supabase import create_client
 from time import sleep
+from clients import get_supabase, get_rest_session
+from watermark import filter_new_rows, update_watermarks
+from rollups import update_rollups
+from rolling import update_tails
+from transform import read_staged, list_staged_files
+from instrumentation import stage, observe_request, count_retry
+from schema import ROLLING_COLUMNS, widen_floats
+from jsonio import dumps, resolve_backend
 
 load_dotenv()
 
 BASE_DIR = Path(__file__).resolve().parents[0]
 STAGED_DIR = BASE_DIR / "data" / "staged"
+DEAD_LETTER_DIR = BASE_DIR / "data" / "dead_letter"
+DEAD_LETTER_DIR.mkdir(parents=True, exist_ok=True)
 
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 TABLE_NAME = "air_quality_data"
+CONFLICT_KEY = "city,time"  # Unique key for idempotent upserts
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise SystemExit("Please check .env for SUPABASE_URL and SUPABASE_KEY")
+# Loader tuning (override via .env / environment)
+LOAD_CONCURRENCY = int(os.getenv("LOAD_CONCURRENCY", "4"))  # batches in flight
+LOAD_BATCH_SIZE = int(os.getenv("LOAD_BATCH_SIZE", "200"))  # starting batch size
+LOAD_MIN_BATCH = int(os.getenv("LOAD_MIN_BATCH", "50"))
+LOAD_MAX_BATCH = int(os.getenv("LOAD_MAX_BATCH", "2000"))
+LOAD_TARGET_LATENCY = float(os.getenv("LOAD_TARGET_LATENCY", "1.0"))  # seconds per batch
+LOAD_MAX_RETRIES = int(os.getenv("LOAD_MAX_RETRIES", "4"))
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Loader backend: supabase (REST upserts, default), postgres (COPY via DATABASE_URL)
+# or duckdb (local embedded store, no network)
+LOAD_BACKEND = os.getenv("LOAD_BACKEND", "supabase").lower()
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# PostgREST endpoint behind Supabase, used for bulk inserts of pre-serialized batches.
+# Clients are created lazily (see clients.py); credentials are checked on first use.
+REST_URL = f"{(SUPABASE_URL or '').rstrip('/')}/rest/v1"
+UPSERT_HEADERS = {
+    # Upsert: rows already present for (city, time) are updated, not duplicated
+    "Prefer": "resolution=merge-duplicates,return=minimal",
+}
+
+ADD_ROLLING_COLUMNS = ",\n".join(f"    ADD COLUMN IF NOT EXISTS {col} DOUBLE PRECISION" for col in ROLLING_COLUMNS)
 
 # Exact Schema requested
 CREATE_TABLE_SQL = f"""
@@ -133,83 +170,288 @@ CREATE TABLE IF NOT EXISTS public.{TABLE_NAME} (
     aqi_category TEXT,
     severity_score DOUBLE PRECISION,
     risk_flag TEXT,
-    hour INTEGER
+    hour INTEGER,
+    UNIQUE (city, time)
 );
+-- Existing tables without the upsert key: drop duplicate (city, time) rows,
+-- keeping the latest insert of each, then add the key
+DO $$
+BEGIN
+    IF to_regclass('public.{TABLE_NAME}_city_time_key') IS NULL THEN
+        DELETE FROM public.{TABLE_NAME} older USING public.{TABLE_NAME} newer
+        WHERE older.city = newer.city AND older.time = newer.time AND older.id < newer.id;
+        CREATE UNIQUE INDEX {TABLE_NAME}_city_time_key ON public.{TABLE_NAME} (city, time);
+    END IF;
+END $$;
+-- Rolling-window averages (24h PM, 8h O3/CO, PM NowCast)
+ALTER TABLE public.{TABLE_NAME}
+{ADD_ROLLING_COLUMNS};
 """
 
 def create_table_if_not_exists():
     try:
         print(f"🔧 Creating table '{TABLE_NAME}'...")
-        supabase.rpc("execute_sql", {"query": CREATE_TABLE_SQL}).execute()
+        get_supabase().rpc("execute_sql", {"query": CREATE_TABLE_SQL}).execute()
         print(f"✅ Table '{TABLE_NAME}' ready.")
     except Exception as e:
         print(f"⚠️ RPC Error: {e}")
         print("ℹ️  Please run the SQL manually in Supabase Dashboard.")
         print(CREATE_TABLE_SQL)
 
-def clean_record_for_json(record):
+# Errors caused by the table rather than the batch (missing table, column or
+# (city, time) unique index): every batch would fail the same way
+SCHEMA_ERRORS = {"42P01", "42703", "42P10", "PGRST204", "PGRST205"}
+_migrated = False
+_verified_columns = set()
+
+def ensure_table(columns=()):
     """
-    Sanitizes record to ensure JSON compliance (NaN -> None).
-    Also handles column renaming if transform output differed slightly.
+    Applies CREATE_TABLE_SQL through the execute_sql RPC once per process, then
+    checks the table has every column about to be sent (the rolling-window ones
+    included), so a missing migration stops the load before the first upsert
+    instead of dead-lettering every batch. A missing (city, time) key only shows
+    on the first upsert (42P10), which stops the load the same way.
     """
-    cleaned = {}
-    
-    # Map 'risk_classification' from transform to 'risk_flag' for load
-    if "risk_classification" in record:
-        record["risk_flag"] = record.pop("risk_classification")
+    global _migrated
+    wanted = set(CONFLICT_KEY.split(",")) | set(columns)
+    if wanted <= _verified_columns:
+        return
+    if not _migrated:
+        _migrated = True
+        try:
+            get_supabase().rpc("execute_sql", {"query": CREATE_TABLE_SQL}).execute()
+            print(f"🔧 Table '{TABLE_NAME}' migrated.")
+        except Exception as e:
+            print(f"ℹ️  Migration RPC unavailable ({e}), checking the existing table...")
+    resp = get_rest_session(LOAD_CONCURRENCY).get(
+        f"{REST_URL}/{TABLE_NAME}", params={"select": ",".join(sorted(wanted)), "limit": 0}, timeout=30
+    )
+    if resp.status_code >= 400:
+        schema_mismatch(f"{resp.status_code}: {resp.text[:200]}")
+    _verified_columns.update(wanted)
 
-    for key, value in record.items():
-        # Handle NaN/Inf
-        if pd.isna(value):
-            cleaned[key] = None
-        elif isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
-            cleaned[key] = None
-        # Handle Time
-        elif key == "time":
-            cleaned[key] = str(value) if str(value).lower() != "nan" else None
+def schema_mismatch(detail):
+    print(CREATE_TABLE_SQL)
+    raise SystemExit(f"Table '{TABLE_NAME}' doesn't match the loader ({detail}). "
+                     "Run the SQL above in the Supabase SQL editor.")
+
+def sanitize_frame(df):
+    """
+    Renames 'risk_classification' to 'risk_flag', formats time as text and
+    maps Inf to NaN (sent as null), all vectorized.
+    """
+    # float32 readings go out with their exact decimal digits
+    df = widen_floats(df.rename(columns={"risk_classification": "risk_flag"}))
+    if "time" in df.columns and pd.api.types.is_datetime64_any_dtype(df["time"]):
+        # Same text as str(Timestamp) / the CSV staging format; NaT stays null
+        df["time"] = df["time"].dt.strftime("%Y-%m-%d %H:%M:%S")
+    numeric = df.select_dtypes(include="number").columns
+    df[numeric] = df[numeric].replace([np.inf, -np.inf], np.nan)
+    return df
+
+def payload_rows(df):
+    """Sanitized frame -> row dicts, converted once and sliced into batches."""
+    if resolve_backend() == "json":
+        # orjson/msgspec write NaN as null, stdlib json would write a bare NaN
+        df = df.astype(object).where(df.notna(), None)
+    return df.to_dict(orient="records")
+
+def batch_payload(rows, start, end):
+    """JSON array payload for rows [start, end) at full float precision; NaN/None serialize as null."""
+    return dumps(rows[start:end], indent=False).decode()
+
+def upsert_payload(payload):
+    resp = get_rest_session(LOAD_CONCURRENCY).post(
+        f"{REST_URL}/{TABLE_NAME}", params={"on_conflict": CONFLICT_KEY},
+        data=payload.encode(), headers=UPSERT_HEADERS, timeout=30
+    )
+    resp.raise_for_status()
+
+class AdaptiveBatchSizer:
+    """Grows the batch size while requests stay fast, shrinks it on slow or failed ones."""
+
+    def __init__(self, size=LOAD_BATCH_SIZE, min_size=LOAD_MIN_BATCH, max_size=LOAD_MAX_BATCH,
+                 target_latency=LOAD_TARGET_LATENCY):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = min(max(size, min_size), max_size)
+        self.target_latency = target_latency
+        self.lock = threading.Lock()
+
+    def record(self, latency, ok):
+        with self.lock:
+            if not ok:
+                self.size = max(self.min_size, self.size // 2)
+            elif latency < self.target_latency / 2:
+                self.size = min(self.max_size, int(self.size * 1.5))
+            elif latency > self.target_latency:
+                self.size = max(self.min_size, int(self.size * 0.75))
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def is_retryable(error):
+    # Client errors (bad payload/schema) won't fix themselves; timeouts and throttling will
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status >= 500 or status in (408, 429)
+    return True
+
+def is_schema_error(error):
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        try:
+            return error.response.json().get("code") in SCHEMA_ERRORS
+        except ValueError:
+            return False
+    return False
+
+def upsert_with_retry(payload, sizer=None):
+    """Returns None on success, or the last error after retries are exhausted."""
+    for attempt in range(LOAD_MAX_RETRIES + 1):
+        started = time.monotonic()
+        try:
+            upsert_payload(payload)
+            latency = time.monotonic() - started
+            observe_request("upsert", latency)
+            if sizer:
+                sizer.record(latency, ok=True)
+            return None
+        except Exception as e:
+            latency = time.monotonic() - started
+            observe_request("upsert", latency, ok=False)
+            if sizer:
+                sizer.record(latency, ok=False)
+            if attempt == LOAD_MAX_RETRIES or not is_retryable(e):
+                return e
+            count_retry("upsert")
+            delay = backoff_delay(attempt)
+            print(f"   ⚠️ Batch failed (Attempt {attempt+1}/{LOAD_MAX_RETRIES+1}): {e}. Retrying in {delay:.1f}s")
+            sleep(delay)
+
+def write_dead_letter(payloads):
+    """Appends failed batch payloads (one JSON array per line) for a later replay."""
+    path = DEAD_LETTER_DIR / f"{TABLE_NAME}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+    with open(path, "a") as f:
+        for payload in payloads:
+            f.write(payload + "\n")
+    print(f"   🪦 {len(payloads)} failed batches written to {path}")
+    return path
+
+def replay_dead_letters():
+    """Re-sends dead-lettered batches; upserts make this safe to repeat."""
+    files = sorted(DEAD_LETTER_DIR.glob(f"{TABLE_NAME}_*.jsonl"))
+    for path in files:
+        payloads = [line for line in path.read_text().splitlines() if line.strip()]
+        print(f"♻️  Replaying {len(payloads)} dead-lettered batches from {path.name}...")
+        failed = []
+        for payload in payloads:
+            if upsert_with_retry(payload) is None:
+                replayed = pd.DataFrame(json.loads(payload))
+                update_rollups(replayed)
+                update_tails(replayed)
+            else:
+                failed.append(payload)
+        if failed:
+            path.write_text("".join(p + "\n" for p in failed))
+            print(f"   ⚠️ {len(failed)} batches still failing, kept in {path.name}")
         else:
-            cleaned[key] = value
-    return cleaned
+            path.unlink()
 
-def load_to_supabase(csv_path):
-    if not csv_path or not Path(csv_path).exists():
-        print(f"⚠️ File missing: {csv_path}")
+def load_to_supabase(staged_path):
+    if not staged_path or not Path(staged_path).exists():
+        print(f"⚠️ File missing: {staged_path}")
         return
 
-    print(f"📦 Loading {Path(csv_path).name} to '{TABLE_NAME}'...")
-    df = pd.read_csv(csv_path)
+    print(f"📦 Loading {Path(staged_path).name} to '{TABLE_NAME}'...")
+    df = read_staged(staged_path)
 
-    # Convert to dictionary records
-    raw_records = df.to_dict(orient="records")
-    
-    # Clean records
-    cleaned_records = [clean_record_for_json(rec) for rec in raw_records]
-    total = len(cleaned_records)
-    
-    # Batch Insert (Size = 200)
-    BATCH_SIZE = 200
-    
-    for i in range(0, total, BATCH_SIZE):
-        batch = cleaned_records[i:i+BATCH_SIZE]
-        
-        # Retry Logic (2 Retries)
-        max_retries = 2
-        for attempt in range(max_retries + 1):
-            try:
-                supabase.table(TABLE_NAME).insert(batch).execute()
-                print(f"   > Inserted rows {i+1}-{min(i+BATCH_SIZE, total)}")
-                break # Success, exit retry loop
-            except Exception as e:
-                print(f"   ⚠️ Batch failed (Attempt {attempt+1}/{max_retries+1}): {e}")
-                if attempt < max_retries:
-                    sleep(2) # Wait before retry
+    # Skip rows at or below the per-city watermark (already loaded)
+    df = filter_new_rows(df)
+    # One row per key, the last one wins: Postgres rejects a batch that hits a key
+    # twice, and batches in flight together would race for it
+    df = df.drop_duplicates(subset=["city", "time"], keep="last")
+
+    # Clean once at the column level, then serialize each batch straight to JSON
+    with stage("load.sanitize", rows=len(df)):
+        sanitized = sanitize_frame(df)
+        records = payload_rows(sanitized)
+    total = len(records)
+
+    # Create the shared session up front (fails fast on missing credentials),
+    # and make sure the table has every column before anything is sent
+    get_rest_session(LOAD_CONCURRENCY)
+    ensure_table(sanitized.columns)
+
+    # Batches that failed on an earlier run go first
+    replay_dead_letters()
+
+    sizer = AdaptiveBatchSizer()
+    loaded, dead = [], []
+    position = 0
+    schema_error = None
+
+    def send(start, end):
+        payload = batch_payload(records, start, end)
+        return start, end, payload, upsert_with_retry(payload, sizer)
+
+    # Keep up to LOAD_CONCURRENCY batches in flight; each new batch uses the current adaptive size
+    with ThreadPoolExecutor(max_workers=max(1, LOAD_CONCURRENCY)) as pool:
+        in_flight = set()
+        # A schema error stops new batches; the ones in flight still finish
+        while in_flight or (position < total and schema_error is None):
+            while position < total and schema_error is None and len(in_flight) < max(1, LOAD_CONCURRENCY):
+                end = min(position + sizer.size, total)
+                in_flight.add(pool.submit(send, position, end))
+                position = end
+            done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                start, end, payload, error = future.result()
+                if error is None:
+                    print(f"   > Upserted rows {start+1}-{end}")
+                    loaded.append(df.iloc[start:end])
+                elif is_schema_error(error):
+                    print(f"   ❌ Rows {start+1}-{end} rejected by the table: {error}")
+                    schema_error = error
                 else:
-                    print(f"   ❌ Skipping batch starting at row {i+1} due to repeated errors.")
+                    print(f"   ❌ Rows {start+1}-{end} failed after retries: {error}")
+                    dead.append(payload)
+
+    if dead:
+        write_dead_letter(dead)
+
+    # Only advance watermarks, rollups and rolling tails for rows that actually made it in
+    upserted = sum(len(part) for part in loaded)
+    if loaded:
+        loaded = pd.concat(loaded)
+        update_watermarks(loaded)
+        update_rollups(loaded)
+        update_tails(loaded)
 
-    print(f"🎯 Load Complete. Processed {total} rows.")
+    if schema_error is not None:
+        schema_mismatch(schema_error.response.text[:200])
+    if total and not upserted:
+        raise RuntimeError(f"No rows loaded: all {len(dead)} batches failed and were dead-lettered.")
+    print(f"🎯 Load Complete. Upserted {upserted} of {total} rows.")
+    return upserted
+
+def load_data(staged_path, backend=LOAD_BACKEND):
+    """Loads a staged file with the configured backend; returns the rows processed."""
+    with stage("load", backend=backend) as metrics:
+        if staged_path and Path(staged_path).exists():
+            metrics["bytes"] = Path(staged_path).stat().st_size
+        if backend == "postgres":
+            from pg_load import load_to_postgres
+            rows = load_to_postgres(staged_path)
+        elif backend == "duckdb":
+            from local_store import load_to_duckdb
+            rows = load_to_duckdb(staged_path)
+        else:
+            rows = load_to_supabase(staged_path)
+        metrics["rows"] = rows or 0
+    return rows
 
 if __name__ == "__main__":
-    staged_files = sorted([str(p) for p in STAGED_DIR.glob("air_quality_transform_*.csv")])
+    staged_files = list_staged_files()
     if staged_files:
-        create_table_if_not_exists()
-        load_to_supabase(staged_files[-1])
\ No newline at end of file
+        load_data(staged_files[-1])
\ No newline at end of file
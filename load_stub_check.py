@@ -0,0 +1,90 @@
+# load_stub_check.py
+import os
+import sys
+import json
+import threading
+import pandas as pd
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+# Batches larger than one run's payloads, so a run's rows and the next run's
+# revisions of them go out in the same request
+os.environ.setdefault("LOAD_BATCH_SIZE", "500")
+
+# bench keeps every bit of pipeline state in a scratch directory
+from bench import SCRATCH, reset_state
+from transform_parity import overlapping_raw
+import load
+import transform
+from transform import read_staged, transform_data
+
+class StubPostgREST(BaseHTTPRequestHandler):
+    """
+    Just enough PostgREST for the loader: the migration RPC, the column probe and
+    upserts on (city, time), which fail like Postgres when a batch hits a key twice.
+    """
+    table = {}
+    rejected = 0
+
+    def reply(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply(200, b"[]")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if urlparse(self.path).path.endswith(f"/{load.TABLE_NAME}"):
+            rows = json.loads(body)
+            keys = [(row["city"], row["time"]) for row in rows]
+            if len(set(keys)) < len(keys):
+                StubPostgREST.rejected += 1
+                return self.reply(400, json.dumps({
+                    "code": "21000", "message": "ON CONFLICT DO UPDATE command cannot affect row a second time",
+                }).encode())
+            StubPostgREST.table.update(zip(keys, rows))
+        self.reply(200, b"null")
+
+    def log_message(self, *args):
+        pass
+
+def check_rest_upserts():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubPostgREST)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["SUPABASE_URL"] = f"http://127.0.0.1:{server.server_port}"
+    load.REST_URL = f"{os.environ['SUPABASE_URL']}/rest/v1"
+    load.DEAD_LETTER_DIR = SCRATCH / "dead_letter"
+    load.DEAD_LETTER_DIR.mkdir(exist_ok=True)
+    transform.STAGED_DIR = SCRATCH / "staged"
+    transform.STAGED_DIR.mkdir(exist_ok=True)
+
+    print("\n🔬 Overlapping runs upserted through a PostgREST stub")
+    reset_state()
+    staged = transform_data(overlapping_raw(0, cities=2), tag="stub_check")
+    load.load_to_supabase(staged)
+    server.shutdown()
+
+    # The table must hold one row per key, with the values of its last staged row
+    expected = read_staged(staged).drop_duplicates(subset=["city", "time"], keep="last")
+    expected = load.sanitize_frame(expected).set_index(["city", "time"])["pm2_5"]
+    stored = pd.Series({key: row["pm2_5"] for key, row in StubPostgREST.table.items()}, dtype="float64")
+    got = stored.reindex(expected.index)
+    stale = int((~((got == expected) | (got.isna() & expected.isna()))).sum())
+    dead = list(load.DEAD_LETTER_DIR.glob("*.jsonl"))
+
+    checks = {
+        f"{len(expected)} staged keys, {len(stored)} rows in the table": len(stored) == len(expected),
+        f"{StubPostgREST.rejected} batches rejected for repeated keys": StubPostgREST.rejected == 0,
+        f"{len(dead)} dead-letter files": not dead,
+        f"{stale} rows not holding their latest staged reading": stale == 0,
+    }
+    for label, ok in checks.items():
+        print(f"{'✅' if ok else '❌'} {label}")
+    return all(checks.values())
+
+if __name__ == "__main__":
+    sys.exit(0 if check_rest_upserts() else 1)
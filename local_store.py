@@ -0,0 +1,73 @@
+# local_store.py
+import os
+from pathlib import Path
+from pg_load import copy_frame
+from transform import read_staged
+from watermark import filter_new_rows, update_watermarks
+from rollups import update_rollups
+from rolling import update_tails
+from schema import ROLLING_COLUMNS
+
+BASE_DIR = Path(__file__).resolve().parents[0]
+WAREHOUSE_DIR = BASE_DIR / "data" / "warehouse"
+WAREHOUSE_DIR.mkdir(parents=True, exist_ok=True)
+
+DUCKDB_PATH = Path(os.getenv("DUCKDB_PATH", WAREHOUSE_DIR / "air_quality.duckdb"))
+TABLE_NAME = "air_quality_data"
+
+# Same columns as the Supabase table; (city, time) is the upsert key
+LOCAL_TABLE_SQL = f"""
+CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+    city VARCHAR,
+    time TIMESTAMP,
+    hour INTEGER,
+    pm10 DOUBLE,
+    pm2_5 DOUBLE,
+    carbon_monoxide DOUBLE,
+    nitrogen_dioxide DOUBLE,
+    sulphur_dioxide DOUBLE,
+    ozone DOUBLE,
+    uv_index DOUBLE,
+    aqi_category VARCHAR,
+    severity_score DOUBLE,
+    risk_flag VARCHAR,
+    PRIMARY KEY (city, time)
+);
+""" + "".join(
+    # Rolling-window averages; also added to stores created before they existed
+    f"ALTER TABLE {TABLE_NAME} ADD COLUMN IF NOT EXISTS {col} DOUBLE;\n" for col in ROLLING_COLUMNS
+)
+
+def connect(read_only=False):
+    try:
+        import duckdb
+    except ImportError:
+        raise SystemExit("LOAD_BACKEND=duckdb needs the duckdb package (pip install duckdb)")
+    con = duckdb.connect(str(DUCKDB_PATH), read_only=read_only and DUCKDB_PATH.exists())
+    if not read_only:
+        con.execute(LOCAL_TABLE_SQL)
+    return con
+
+def load_to_duckdb(staged_path):
+    """Upserts a staged file into the local DuckDB store (no network needed)."""
+    if not staged_path or not Path(staged_path).exists():
+        print(f"⚠️ File missing: {staged_path}")
+        return
+
+    print(f"📦 Loading {Path(staged_path).name} to local '{DUCKDB_PATH.name}'...")
+    df = filter_new_rows(read_staged(staged_path))
+    rows = copy_frame(df)
+    for col in ["aqi_category", "risk_flag"]:
+        rows[col] = rows[col].astype(object)
+    cols = ", ".join(rows.columns)
+
+    with connect() as con:
+        con.register("incoming", rows)
+        con.execute(f"INSERT OR REPLACE INTO {TABLE_NAME} ({cols}) SELECT {cols} FROM incoming")
+        con.unregister("incoming")
+
+    update_watermarks(df)
+    update_rollups(df)
+    update_tails(df)
+    print(f"🎯 Load Complete. Processed {len(rows)} rows.")
+    return len(rows)
@@ -0,0 +1,100 @@
+# pg_load.py
+import io
+import os
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from load import CREATE_TABLE_SQL, DATABASE_URL, TABLE_NAME
+from transform import POLLUTANTS, read_staged
+from watermark import filter_new_rows, update_watermarks
+from rollups import update_rollups
+from rolling import update_tails
+from schema import ROLLING_COLUMNS, widen_floats
+
+# COPY wire format: csv (vectorized via to_csv) or binary (typed rows via psycopg)
+COPY_FORMAT = os.getenv("COPY_FORMAT", "csv").lower()
+COPY_CHUNK_ROWS = 100_000
+
+STAGE_TABLE = f"{TABLE_NAME}_stage"
+COPY_COLUMNS = (["city", "time", "hour"] + POLLUTANTS + ["aqi_category", "severity_score", "risk_flag"]
+                + ROLLING_COLUMNS)
+COPY_TYPES = (["text", "timestamp", "int4"] + ["float8"] * len(POLLUTANTS) + ["text", "float8", "text"]
+              + ["float8"] * len(ROLLING_COLUMNS))
+
+def copy_frame(df):
+    """
+    Staged frame -> table columns, with NaN/Inf/NaT ready to become NULL and one
+    row per (city, time), the last one winning as with repeated upserts.
+    """
+    df = widen_floats(df.rename(columns={"risk_classification": "risk_flag"}))
+    df["time"] = pd.to_datetime(df["time"])
+    numeric = df.select_dtypes(include="number").columns
+    df[numeric] = df[numeric].replace([np.inf, -np.inf], np.nan)
+    df = df.drop_duplicates(subset=["city", "time"], keep="last")
+    return df[[c for c in COPY_COLUMNS if c in df.columns]]
+
+def merge_sql(columns):
+    cols = ", ".join(columns)
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in columns if c not in ("city", "time"))
+    # copy_frame left one row per key: a row may only be upserted once per statement
+    return f"""
+    INSERT INTO public.{TABLE_NAME} ({cols})
+    SELECT {cols} FROM {STAGE_TABLE}
+    ON CONFLICT (city, time) DO UPDATE SET {updates};
+    """
+
+def copy_rows(cur, df, copy_format=COPY_FORMAT):
+    cols = ", ".join(df.columns)
+    if copy_format == "binary":
+        types = [COPY_TYPES[COPY_COLUMNS.index(c)] for c in df.columns]
+        with cur.copy(f"COPY {STAGE_TABLE} ({cols}) FROM STDIN (FORMAT BINARY)") as copy:
+            copy.set_types(types)
+            for start in range(0, len(df), COPY_CHUNK_ROWS):
+                chunk = df.iloc[start:start + COPY_CHUNK_ROWS].astype(object)
+                chunk = chunk.where(chunk.notna(), None)
+                for row in chunk.itertuples(index=False, name=None):
+                    copy.write_row(row)
+    else:
+        # Unquoted empty fields are NULL in CSV COPY
+        with cur.copy(f"COPY {STAGE_TABLE} ({cols}) FROM STDIN (FORMAT CSV)") as copy:
+            for start in range(0, len(df), COPY_CHUNK_ROWS):
+                buf = io.StringIO()
+                df.iloc[start:start + COPY_CHUNK_ROWS].to_csv(
+                    buf, header=False, index=False, date_format="%Y-%m-%d %H:%M:%S"
+                )
+                copy.write(buf.getvalue())
+
+def load_to_postgres(staged_path, dsn=DATABASE_URL, copy_format=COPY_FORMAT):
+    """
+    Bulk-loads a staged file straight into Postgres: COPY FROM STDIN into a
+    temp table, then one upsert into the main table on (city, time).
+    """
+    import psycopg
+
+    if not dsn:
+        raise SystemExit("Please check .env for DATABASE_URL (LOAD_BACKEND=postgres)")
+    if not staged_path or not Path(staged_path).exists():
+        print(f"⚠️ File missing: {staged_path}")
+        return
+
+    print(f"📦 COPY-loading {Path(staged_path).name} to '{TABLE_NAME}' ({copy_format})...")
+    df = filter_new_rows(read_staged(staged_path))
+    rows = copy_frame(df)
+
+    with psycopg.connect(dsn) as conn:
+        with conn.cursor() as cur:
+            cur.execute(CREATE_TABLE_SQL)
+            cur.execute(
+                f"CREATE TEMP TABLE {STAGE_TABLE} ON COMMIT DROP AS "
+                f"SELECT {', '.join(rows.columns)} FROM public.{TABLE_NAME} WITH NO DATA"
+            )
+            copy_rows(cur, rows, copy_format)
+            cur.execute(merge_sql(rows.columns))
+            print(f"   > Upserted {cur.rowcount} rows")
+        # Leaving the block commits; watermarks only move once the data is in
+    update_watermarks(df)
+    update_rollups(df)
+    update_tails(df)
+
+    print(f"🎯 Load Complete. Processed {len(rows)} rows.")
+    return len(rows)
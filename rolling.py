@@ -0,0 +1,212 @@
+# rolling.py
+import os
+import json
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from jsonio import write_json_atomic
+from schema import ROLLING_COLUMNS, apply_schema, float32_to_float64
+from watermark import FORECAST_DAYS, STATE_DIR, TIME_FORMAT, load_watermarks
+
+TAIL_FILE = Path(os.getenv("ROLLING_TAIL_FILE", STATE_DIR / "rolling_tail.json"))
+
+# Averaging windows in hours (EPA-style 24h PM and 8h ozone/CO means)
+ROLLING_WINDOWS = {
+    "pm2_5_24h": ("pm2_5", 24),
+    "pm10_24h": ("pm10", 24),
+    "ozone_8h": ("ozone", 8),
+    "carbon_monoxide_8h": ("carbon_monoxide", 8),
+}
+# A window mean needs this share of its hours present (18 of 24, 6 of 8)
+ROLLING_MIN_COVERAGE = float(os.getenv("ROLLING_MIN_COVERAGE", "0.75"))
+
+# NowCast: 12h average weighted towards recent hours by min/max over the window
+NOWCAST = {"pm2_5_nowcast": "pm2_5", "pm10_nowcast": "pm10"}
+NOWCAST_HOURS = 12
+NOWCAST_MIN_WEIGHT = 0.5  # PM weight factor floor
+NOWCAST_RECENT = (3, 2)  # at least 2 of the 3 latest hours must be present
+
+SOURCES = sorted({col for col, _ in ROLLING_WINDOWS.values()} | set(NOWCAST.values()))
+# Hours before a row that its windows reach back to
+TAIL_HOURS = max([hours for _, hours in ROLLING_WINDOWS.values()] + [NOWCAST_HOURS]) - 1
+HOUR = pd.Timedelta(hours=1)
+# Hours one payload covers; a later file without a watermark starts within them
+FORECAST_HOURS = FORECAST_DAYS * 24
+
+# Windows are summed lag by lag in a fixed order, so a row's value depends only
+# on the hours in its window: carrying the hours a later row can still reach
+# from run to run gives bit-for-bit the same results as recomputing over everything.
+#
+# Overlap rule: raw files can cover the same (city, time) twice (a later run's
+# forecast revising an earlier one). Rows are taken in input order and a row's
+# windows see the readings as of its own file: its file's values, and for other
+# hours the latest ones read before it. A later file never changes an earlier
+# row's windows. Batch, streaming and parallel transforms read rows in the same
+# order, so they agree row for row whatever the chunking.
+
+def empty_tails():
+    return apply_schema(pd.DataFrame({"city": [], "time": [], **{col: [] for col in SOURCES}}))
+
+def load_tails():
+    """Returns the carried-over rows (city, time, source readings) from the state file."""
+    if not TAIL_FILE.exists():
+        return empty_tails()
+    try:
+        return apply_schema(pd.DataFrame(json.loads(TAIL_FILE.read_text())))
+    except Exception as e:
+        print(f"⚠️ Could not read rolling tails ({e}), windows restart from the next rows.")
+        return empty_tails()
+
+def save_tails(tails):
+    data = {"city": tails["city"].astype(str).tolist(), "time": tails["time"].dt.strftime(TIME_FORMAT).tolist()}
+    for col in SOURCES:
+        # Shortest decimals read back as the same float32 values
+        values = float32_to_float64(tails[col].to_numpy())
+        data[col] = np.where(np.isnan(values), None, values).tolist()
+    write_json_atomic(TAIL_FILE, data)
+
+def source_rows(df):
+    """city, time and source readings of `df`, typed per the shared schema."""
+    rows = apply_schema(df.reindex(columns=["city", "time"] + SOURCES))
+    rows["city"] = rows["city"].astype(object)  # categories differ between frames
+    return rows[rows["city"].notna() & rows["time"].notna()]
+
+def overlay(history, rows):
+    """`rows` laid over `history`: where both have a (city, time), the row read later wins."""
+    merged = pd.concat([history, rows], ignore_index=True)
+    return merged.drop_duplicates(subset=["city", "time"], keep="last")
+
+def merge_tails(tails, df, watermarks=None):
+    """
+    Folds `df` into `tails` (later rows win) and keeps what later rows can reach.
+    Only rows after a city's watermark get transformed, and later files start at
+    its date, so that is every hour after the watermark minus TAIL_HOURS. For a
+    city without one, later files start less than FORECAST_HOURS before the
+    latest hour read, so their windows reach FORECAST_HOURS + TAIL_HOURS back.
+    """
+    merged = overlay(source_rows(tails), source_rows(df))
+    marks = pd.to_datetime(merged["city"].map(watermarks or {}))
+    latest = merged.groupby("city")["time"].transform("max")
+    cutoff = marks.fillna(latest - FORECAST_HOURS * HOUR) - TAIL_HOURS * HOUR
+    merged = merged[merged["time"] > cutoff]
+    return apply_schema(merged.sort_values(["city", "time"]).reset_index(drop=True))
+
+def update_tails(df):
+    """Carries the hours the next run's windows can reach over from freshly loaded rows."""
+    if df is None or df.empty:
+        return
+    tails = merge_tails(load_tails(), df, load_watermarks())
+    save_tails(tails)
+    print(f"🪟 Rolling tails updated for {tails['city'].nunique()} cities.")
+
+def hourly_grid(history):
+    """
+    Lays each city's rows (sorted by city, time) on a gap-free hourly grid.
+    Returns the grid readings (missing hours NaN), each grid slot's hours since
+    its city's first slot, and a slot lookup for (city, time) pairs.
+    """
+    codes, cities = pd.factorize(history["city"])
+    hours = history["time"].to_numpy().astype("datetime64[h]").astype(np.int64)
+    first = pd.Series(hours).groupby(codes).min().to_numpy()
+    span = pd.Series(hours).groupby(codes).max().to_numpy() - first + 1
+    start = np.concatenate([[0], np.cumsum(span)[:-1]])
+
+    grid = np.full((int(span.sum()), len(SOURCES)), np.nan)
+    grid[start[codes] + hours - first[codes]] = np.column_stack(
+        [float32_to_float64(history[col].to_numpy()) for col in SOURCES]
+    )
+    offset = np.arange(len(grid)) - np.repeat(start, span)
+
+    def slots(city, time):
+        code = cities.get_indexer(city)
+        hour = time.to_numpy().astype("datetime64[h]").astype(np.int64)
+        return start[code] + hour - first[code]
+    return grid, offset, slots
+
+def lagged(grid, offset, lag):
+    """`grid` shifted `lag` hours later within each city (NaN before the city's first slot)."""
+    if lag == 0:
+        return grid
+    out = np.full_like(grid, np.nan)
+    out[lag:] = grid[:-lag]
+    out[offset < lag] = np.nan
+    return out
+
+def window_mean(grid, offset, hours):
+    total, count = np.zeros_like(grid), np.zeros_like(grid)
+    for lag in range(hours):
+        values = lagged(grid, offset, lag)
+        present = ~np.isnan(values)
+        total += np.where(present, values, 0.0)
+        count += present
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(count >= np.ceil(hours * ROLLING_MIN_COVERAGE), total / count, np.nan)
+
+def nowcast(grid, offset):
+    # Pass 1: min/max over the window and coverage of the latest hours
+    low, high = np.full_like(grid, np.nan), np.full_like(grid, np.nan)
+    recent = np.zeros_like(grid)
+    for lag in range(NOWCAST_HOURS):
+        values = lagged(grid, offset, lag)
+        low, high = np.fmin(low, values), np.fmax(high, values)
+        if lag < NOWCAST_RECENT[0]:
+            recent += ~np.isnan(values)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weight = np.clip(np.where(high > 0, low / high, 1.0), NOWCAST_MIN_WEIGHT, 1.0)
+
+    # Pass 2: sum of weight**lag * reading over the hours present
+    total, norm = np.zeros_like(grid), np.zeros_like(grid)
+    for lag in range(NOWCAST_HOURS):
+        values = lagged(grid, offset, lag)
+        present = ~np.isnan(values)
+        factor = weight ** lag
+        total += np.where(present, factor * values, 0.0)
+        norm += np.where(present, factor, 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(recent >= NOWCAST_RECENT[1], total / norm, np.nan)
+
+def window_features(history, rows):
+    """ROLLING_COLUMNS for `rows` (city, time), from the readings in `history`."""
+    # Only history hours a row's window can reach
+    earliest = rows.groupby("city")["time"].min()
+    history = history[history["time"] >= history["city"].map(earliest) - TAIL_HOURS * HOUR]
+    grid, offset, slots = hourly_grid(history.sort_values(["city", "time"]))
+
+    features = {}
+    for hours in sorted({hours for _, hours in ROLLING_WINDOWS.values()}):
+        cols = [col for col, (_, window) in ROLLING_WINDOWS.items() if window == hours]
+        means = window_mean(grid[:, [SOURCES.index(ROLLING_WINDOWS[col][0]) for col in cols]], offset, hours)
+        features.update(zip(cols, means.T))
+    averages = nowcast(grid[:, [SOURCES.index(source) for source in NOWCAST.values()]], offset)
+    features.update(zip(NOWCAST, averages.T))
+
+    at = slots(rows["city"], rows["time"])
+    return {col: features[col][at] for col in ROLLING_COLUMNS}
+
+def add_rolling_features(df, tails=None):
+    """
+    Adds ROLLING_COLUMNS to transformed rows. Windows reach back into `tails`
+    (rows carried over from earlier runs or chunks, read from state when None),
+    so only the new rows are computed, all cities at once.
+    """
+    if df.empty:
+        for col in ROLLING_COLUMNS:
+            df[col] = pd.Series(dtype="float32")
+        return df
+    history = source_rows(tails if tails is not None else load_tails())
+    rows = source_rows(df.reset_index(drop=True))
+
+    # A city's time going back starts a new pass (a later file overlapping an
+    # earlier one); passes are laid over the history one after the other
+    previous = rows.groupby("city")["time"].shift()
+    passes = (rows["time"] <= previous).astype(int).groupby(rows["city"]).cumsum()
+
+    values = {col: np.full(len(df), np.nan, dtype=np.float32) for col in ROLLING_COLUMNS}
+    for number in range(int(passes.max()) + 1 if len(rows) else 0):
+        part = rows[passes == number]
+        history = overlay(history, part)
+        for col, computed in window_features(history, part).items():
+            values[col][part.index] = computed
+    for col in ROLLING_COLUMNS:
+        df[col] = values[col]
+    return df
@@ -0,0 +1,263 @@
+# rollups.py
+import json
+import os
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from jsonio import write_json_atomic
+from schema import widen_floats
+from watermark import STATE_DIR, load_watermarks
+
+ROLLUP_FILE = Path(os.getenv("ROLLUP_FILE", STATE_DIR / "rollups.json"))
+ROLLUP_VERSION = 2  # bump when the state layout changes (older files are rebuilt)
+
+# Sums are kept as integers in millionths of a µg/m³ (readings carry at most a
+# few decimals), so folding in new rows batch by batch gives exactly the same
+# averages as rebuilding from every row.
+SCALE = 10 ** 6
+
+# Loads upsert on (city, time), so a row can come in more than once. Rows newer
+# than their city's watermark are "open": forecasts get rewritten by later loads,
+# so each open row's contribution is kept and replaced when the row comes again.
+# Rows at or below the watermark are closed into per-city runs of hours, and a
+# closed row coming in again (e.g. a dead-letter replay) is not counted twice.
+
+def empty_rollups():
+    return {"version": ROLLUP_VERSION, "city": {}, "hour": {}, "city_hour": {}, "risk": {},
+            "max_severity": None, "open": {}, "closed": {}}
+
+def load_rollups():
+    """Returns the rollup state, or None if it has not been built yet."""
+    if not ROLLUP_FILE.exists():
+        return None
+    try:
+        state = json.loads(ROLLUP_FILE.read_text())
+    except Exception as e:
+        print(f"⚠️ Could not read rollups ({e}), they will be rebuilt.")
+        return None
+    if state.get("version") != ROLLUP_VERSION:
+        print("ℹ️  Rollups were written by an older version, they will be rebuilt.")
+        return None
+    return state
+
+def save_rollups(state):
+    write_json_atomic(ROLLUP_FILE, state, indent=2, sort_keys=True)
+
+def hour_slots(times):
+    """Hours since the epoch; NaT becomes -1 (not tracked)."""
+    times = pd.to_datetime(times)
+    slots = times.to_numpy().astype("datetime64[h]").astype(np.int64)
+    return np.where(times.notna().to_numpy(), slots, -1)
+
+def hour_runs(slots):
+    """Hour numbers -> sorted [[first, last], ...] runs of consecutive hours."""
+    slots = np.unique(np.asarray(slots, dtype=np.int64))
+    if not len(slots):
+        return []
+    breaks = np.flatnonzero(np.diff(slots) > 1)
+    firsts = np.concatenate([slots[:1], slots[breaks + 1]])
+    lasts = np.concatenate([slots[breaks], slots[-1:]])
+    return [[int(a), int(b)] for a, b in zip(firsts, lasts)]
+
+def in_runs(slots, runs):
+    if not runs:
+        return np.zeros(len(slots), dtype=bool)
+    runs = np.asarray(runs, dtype=np.int64)
+    at = np.searchsorted(runs[:, 0], slots, side="right") - 1
+    return (at >= 0) & (slots <= runs[np.maximum(at, 0), 1])
+
+def merge_runs(runs, slots):
+    covered = [np.arange(a, b + 1) for a, b in runs]
+    return hour_runs(np.concatenate(covered + [np.asarray(slots, dtype=np.int64)]))
+
+def contributions(df):
+    """
+    One entry per row with what it adds to the buckets: city, time slot,
+    hour of day (-1 if missing), PM2.5 in millionths (with a presence flag),
+    risk flag and severity. Within `df` the last row per (city, time) wins.
+    """
+    # Sum the stored float64 values, not their float32 approximations
+    df = widen_floats(df.rename(columns={"risk_classification": "risk_flag"}))
+    df = df[df["city"].notna()]
+    pm25 = pd.to_numeric(df["pm2_5"], errors="coerce").replace([np.inf, -np.inf], np.nan)
+    hours = pd.to_numeric(df["hour"], errors="coerce")
+    rows = pd.DataFrame({
+        "city": df["city"].astype(str).to_numpy(),
+        "slot": hour_slots(df["time"]) if "time" in df.columns else np.full(len(df), -1),
+        "hour": hours.fillna(-1).astype(np.int64).to_numpy(),
+        "pm": np.rint(pm25.fillna(0).to_numpy(dtype=np.float64) * SCALE).astype(np.int64),
+        "has": pm25.notna().to_numpy().astype(np.int64),
+        "flag": df["risk_flag"].astype(object).where(df["risk_flag"].notna(), None).to_numpy(),
+        "severity": pd.to_numeric(df["severity_score"], errors="coerce").to_numpy(dtype=np.float64),
+    })
+    repeated = (rows["slot"] >= 0) & rows.duplicated(subset=["city", "slot"], keep="last")
+    return rows[~repeated].reset_index(drop=True)
+
+def add_sums(bucket, sums, key):
+    for index, total, count in zip(sums.index, sums["value"], sums["n"]):
+        name = key(index)
+        entry = bucket.setdefault(name, {"sum": 0, "count": 0})
+        entry["sum"] += int(total)
+        entry["count"] += int(count)
+        if not entry["count"]:
+            del bucket[name]
+
+def apply_entries(state, entries):
+    """Adds (sign +1) or retracts (sign -1) contributions in every bucket."""
+    if entries.empty:
+        return
+    entries = entries.assign(value=entries["pm"] * entries["sign"], n=entries["has"] * entries["sign"])
+    # Stringified keys: JSON object keys must be strings
+    add_sums(state["city"], entries.groupby("city")[["value", "n"]].sum(), str)
+    timed = entries[entries["hour"] >= 0]
+    add_sums(state["hour"], timed.groupby("hour")[["value", "n"]].sum(), str)
+    add_sums(state["city_hour"], timed.groupby(["city", "hour"])[["value", "n"]].sum(),
+             lambda key: f"{key[0]}|{key[1]}")
+
+    flagged = entries[entries["flag"].notna()]
+    for (city, flag), n in flagged.groupby(["city", "flag"])["sign"].sum().items():
+        per_city = state["risk"].setdefault(city, {})
+        per_city[flag] = per_city.get(flag, 0) + int(n)
+        if not per_city[flag]:
+            del per_city[flag]
+        if not per_city:
+            del state["risk"][city]
+
+def fold_severity(best, values, cities):
+    """Running max of severity; ties keep the earliest row, like idxmax over the table."""
+    for value, city in zip(values, cities):
+        if not np.isnan(value) and (best is None or value > best["value"]):
+            best = {"value": float(value), "city": city}
+    return best
+
+def mark_slot(watermarks, city):
+    """Hour number of a city's watermark (-1: nothing closed yet)."""
+    mark = watermarks.get(city)
+    return -1 if mark is None else int(hour_slots(pd.Series([mark]))[0])
+
+def close_rows(state, watermarks):
+    """Moves open rows at or below their city's watermark into the closed runs."""
+    for city in list(state["open"]):
+        mark = mark_slot(watermarks, city)
+        rows = state["open"][city]
+        done = [slot for slot in rows if int(slot) <= mark]
+        if not done:
+            continue
+        severity = [np.nan if rows[slot][3] is None else rows[slot][3] for slot in done]
+        state["max_severity"] = fold_severity(state["max_severity"], severity, [city] * len(done))
+        state["closed"][city] = merge_runs(state["closed"].get(city, []), [int(slot) for slot in done])
+        for slot in done:
+            del rows[slot]
+        if not rows:
+            del state["open"][city]
+
+def fold_rows(state, df, watermarks=None):
+    """Folds loaded rows into `state` (in place); rows already counted replace or skip, never add twice."""
+    rows = contributions(df)
+    if rows.empty:
+        return state
+    watermarks = load_watermarks() if watermarks is None else watermarks
+
+    slots = rows["slot"].to_numpy()
+    fresh = np.ones(len(rows), dtype=bool)
+    marks = np.full(len(rows), -1, dtype=np.int64)
+    retract = []
+    for city, index in rows.groupby("city").indices.items():
+        marks[index] = mark_slot(watermarks, city)
+        # Closed rows were counted for good: a replay of one changes nothing
+        fresh[index] = ~in_runs(slots[index], state["closed"].get(city, []))
+        opened = state["open"].get(city, {})
+        if opened:
+            # Open rows loaded again: their earlier contribution is taken back out
+            known = np.fromiter(map(int, opened), dtype=np.int64, count=len(opened))
+            for slot in slots[index][np.isin(slots[index], known)]:
+                retract.append((city, -1, *opened.pop(str(slot))))
+
+    new = rows[fresh]
+    old = pd.DataFrame(retract, columns=["city", "sign", "pm", "hour", "flag", "severity"])
+    old = old.assign(has=old["pm"].notna().astype(np.int64), pm=old["pm"].fillna(0).astype(np.int64),
+                     hour=old["hour"].fillna(-1).astype(np.int64))
+    apply_entries(state, pd.concat([new.assign(sign=1), old], ignore_index=True)[
+        ["city", "hour", "pm", "has", "flag", "sign"]])
+
+    # Earlier open rows settle first, so severity ties keep the earliest row
+    close_rows(state, watermarks)
+
+    # Rows at or below the watermark (or without a time) are final straight away
+    settled = fresh & (slots <= marks)
+    final = rows[settled]
+    if final["severity"].notna().any():
+        top = final.loc[final["severity"].idxmax()]
+        state["max_severity"] = fold_severity(state["max_severity"], [top["severity"]], [top["city"]])
+    for city, index in final[final["slot"] >= 0].groupby("city").indices.items():
+        state["closed"][city] = merge_runs(state["closed"].get(city, []), final["slot"].to_numpy()[index])
+
+    pending = rows[fresh & ~settled]
+    columns = [pending[col].to_numpy(dtype=object).tolist() for col in
+               ["city", "slot", "hour", "pm", "has", "flag", "severity"]]
+    for city, slot, hour, pm, has, flag, severity in zip(*columns):
+        state["open"].setdefault(city, {})[str(slot)] = [
+            pm if has else None, hour if hour >= 0 else None, flag,
+            None if severity != severity else severity,  # NaN -> None
+        ]
+    return state
+
+def build_rollups(df):
+    """Full recompute from every row (used to bootstrap the store)."""
+    state = fold_rows(empty_rollups(), df)
+    save_rollups(state)
+    print(f"🧮 Rollups built from {len(df)} rows.")
+    return state
+
+def update_rollups(df):
+    """Folds newly loaded rows in; no-op until the store has been bootstrapped."""
+    state = load_rollups()
+    if state is None or df is None or df.empty:
+        return
+    save_rollups(fold_rows(state, df))
+    print(f"🧮 Rollups updated with {len(df)} rows.")
+
+def averages(bucket):
+    return pd.Series(
+        {key: v["sum"] / (v["count"] * SCALE) for key, v in sorted(bucket.items()) if v["count"]},
+        dtype="float64",
+    )
+
+def rollup_kpis(state):
+    """KPI metrics and city x risk distribution straight from the rollups."""
+    if not state or not state["city"]:
+        return None, None
+
+    # Closed rows first, then open rows in the order they were loaded
+    top = state["max_severity"]
+    for city, rows in state["open"].items():
+        severity = [np.nan if row[3] is None else row[3] for row in rows.values()]
+        top = fold_severity(top, severity, [city] * len(severity))
+    if top is None:
+        return None, None
+
+    metrics = {}
+
+    # 1. City with highest average PM2.5
+    avg_pm25 = averages(state["city"])
+    metrics["Worst City (Avg PM2.5)"] = avg_pm25.idxmax()
+    metrics["Worst City PM2.5 Value"] = avg_pm25.max()
+
+    # 2. City with highest severity score (Max single event)
+    metrics["Highest Severity Event City"] = top["city"]
+    metrics["Highest Severity Score"] = top["value"]
+
+    # 3. Hour of day with worst AQI (Avg PM2.5)
+    hourly = averages(state["hour"])
+    hourly.index = hourly.index.astype(int)
+    metrics["Worst Hour of Day"] = hourly.sort_index().idxmax()
+
+    # 4. Risk Percentages (Global)
+    risk_dist = pd.DataFrame(state["risk"]).T.fillna(0).astype(int).sort_index()
+    risk_dist = risk_dist[sorted(risk_dist.columns)]
+    risk_dist.index.name, risk_dist.columns.name = "city", "risk_flag"
+    risk_counts = risk_dist.sum() / risk_dist.values.sum() * 100
+    metrics["High Risk %"] = risk_counts.get("High Risk", 0)
+    metrics["Moderate Risk %"] = risk_counts.get("Moderate Risk", 0)
+
+    return metrics, risk_dist
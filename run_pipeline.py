@@ -1,11 +1,65 @@
-import time
+import os
 import sys
+import queue
+import argparse
+import threading
+from datetime import datetime
 from extract import extract_atmos_data
 from transform import transform_data
-from load import load_to_supabase
+from load import load_data, LOAD_BACKEND
 from etl_analysis import run_analysis
+from instrumentation import METRICS_DIR, METRICS_FILE, start_run, finish_run
 
-def run_full_pipeline():
+# Stage-overlapped mode: extract -> transform -> load connected by bounded queues
+STREAM_PIPELINE = os.getenv("PIPELINE_STREAM", "0") == "1"
+QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))  # files buffered between stages
+
+# Fold this run's raw/staged files into the partitioned archive once it succeeds
+COMPACT_AFTER_RUN = os.getenv("PIPELINE_COMPACT", "0") == "1"
+
+class PipelineError(Exception):
+    """A pipeline stage failed; the CLI exits 1, the daemon retries."""
+
+def run_full_pipeline(stream=STREAM_PIPELINE, compact=COMPACT_AFTER_RUN, session=None):
+    """One pipeline cycle; `session` lets a long-running caller reuse its HTTP pool."""
+    start_run()
+    try:
+        if stream:
+            run_streaming_pipeline(session=session)
+        else:
+            run_batch_pipeline(session=session)
+        if compact:
+            from archive import compact as compact_archive
+            print("\n🗜️  Compacting raw/staged files into the archive...")
+            compact_archive()
+    finally:
+        report_run(finish_run())
+
+def report_run(summary):
+    """Prints per-stage timings; the full record is in METRICS_FILE."""
+    print(f"\n⏱️  Run {summary['run_id']}: {summary['wall_s']:.2f}s wall, peak RSS {summary['peak_rss_mb']} MB")
+    for name, s in summary["stages"].items():
+        rows = f", {s['rows']} rows" if s["rows"] else ""
+        print(f"   - {name}: {s['wall_s']:.2f}s wall, {s['cpu_s']:.2f}s CPU{rows}")
+    for name, n in summary["retries"].items():
+        print(f"   - {name}: {n} retries")
+    print(f"   Metrics appended to {METRICS_FILE}")
+
+def profile_pipeline(stream=STREAM_PIPELINE, compact=COMPACT_AFTER_RUN, top=25):
+    """Runs the pipeline under cProfile and prints the hottest functions."""
+    import cProfile
+    import pstats
+
+    path = METRICS_DIR / f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.prof"
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run_full_pipeline, stream=stream, compact=compact)
+    finally:
+        profiler.dump_stats(path)
+        pstats.Stats(str(path)).sort_stats("cumulative").print_stats(top)
+        print(f"🔬 Profile saved to {path} (open with snakeviz or pstats)")
+
+def run_batch_pipeline(session=None):
     print("===================================================")
     print("🌍 STARTING ATMOSTRACK ETL PIPELINE")
     print("===================================================")
@@ -15,15 +69,13 @@ def run_full_pipeline():
     # ---------------------------------------------------------
     print("\n[1/4] 🚀 Extracting Data from Open-Meteo API...")
     try:
-        raw_files = extract_atmos_data()
-        if not raw_files:
-            print("❌ Extraction failed or returned no files. Stopping.")
-            sys.exit(1)
+        raw_files = extract_atmos_data(session=session)
     except Exception as e:
         print(f"❌ Critical Error in Extract: {e}")
-        sys.exit(1)
-    
-    time.sleep(1) # Pause to ensure file system sync
+        raise PipelineError(f"Extract: {e}") from e
+    if not raw_files:
+        print("❌ Extraction failed or returned no files. Stopping.")
+        raise PipelineError("Extraction returned no files")
 
     # ---------------------------------------------------------
     # STEP 2: TRANSFORM
@@ -31,28 +83,23 @@ def run_full_pipeline():
     print("\n[2/4] 🔁 Transforming JSON to CSV...")
     try:
         staged_csv = transform_data(raw_files)
-        if not staged_csv:
-            print("❌ Transformation failed. Stopping.")
-            sys.exit(1)
     except Exception as e:
         print(f"❌ Critical Error in Transform: {e}")
-        sys.exit(1)
-
-    time.sleep(1)
+        raise PipelineError(f"Transform: {e}") from e
 
     # ---------------------------------------------------------
     # STEP 3: LOAD
     # ---------------------------------------------------------
-    print("\n[3/4] 📦 Loading Data to Supabase Table 'air_quality_data'...")
-    try:
-        # Note: We assume create_table_if_not_exists is handled manually 
-        # or inside load_to_supabase if you added it there.
-        load_to_supabase(staged_csv)
-    except Exception as e:
-        print(f"❌ Critical Error in Load: {e}")
-        sys.exit(1)
-
-    time.sleep(2) # Give DB a moment to index
+    print(f"\n[3/4] 📦 Loading Data to 'air_quality_data' ({LOAD_BACKEND})...")
+    if not staged_csv:
+        # Everything fetched is at or below the watermarks (upstream hasn't updated yet)
+        print("ℹ️  Nothing new to load, skipping.")
+    else:
+        try:
+            load_data(staged_csv)
+        except Exception as e:
+            print(f"❌ Critical Error in Load: {e}")
+            raise PipelineError(f"Load: {e}") from e
 
     # ---------------------------------------------------------
     # STEP 4: ANALYSIS
@@ -62,11 +109,141 @@ def run_full_pipeline():
         run_analysis()
     except Exception as e:
         print(f"❌ Critical Error in Analysis: {e}")
-        sys.exit(1)
+        raise PipelineError(f"Analysis: {e}") from e
 
     print("\n===================================================")
     print("✅ PIPELINE COMPLETED SUCCESSFULLY")
     print("===================================================")
 
+def run_streaming_pipeline(queue_size=QUEUE_SIZE, session=None):
+    """
+    Runs extract, transform and load concurrently. Each raw file is transformed
+    (together with any others already waiting) and loaded as soon as it lands;
+    bounded queues make a slow stage hold back the ones before it.
+    """
+    print("===================================================")
+    print("🌍 STARTING ATMOSTRACK ETL PIPELINE (streaming)")
+    print("===================================================")
+
+    raw_queue = queue.Queue(maxsize=queue_size)
+    staged_queue = queue.Queue(maxsize=queue_size)
+    loaded = []
+    failures = []
+    fatal = []  # SystemExit/KeyboardInterrupt raised inside a stage thread
+
+    def transform_stage():
+        batch_no, done = 0, False
+        try:
+            while not done:
+                batch = [raw_queue.get()]
+                # Micro-batch whatever else has already arrived
+                while batch[-1] is not None:
+                    try:
+                        batch.append(raw_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                done = batch[-1] is None
+                batch = [path for path in batch if path is not None]
+                if not batch:
+                    continue
+                batch_no += 1
+                if fatal:
+                    continue  # keep draining so extract never blocks on a full queue
+                try:
+                    staged = transform_data(batch, tag=f"{batch_no:04d}")
+                    if staged:
+                        staged_queue.put(staged)
+                except BaseException as e:
+                    print(f"❌ Transform failed for {len(batch)} files: {e}")
+                    failures.append(e)
+                    if not isinstance(e, Exception):
+                        fatal.append(e)
+        finally:
+            staged_queue.put(None)
+
+    def load_stage():
+        while True:
+            staged = staged_queue.get()
+            if staged is None:
+                break
+            if fatal:
+                continue  # keep draining so transform never blocks on a full queue
+            try:
+                load_data(staged)
+                loaded.append(staged)
+            except BaseException as e:
+                # SystemExit (bad config) too: a dead thread would leave the queues blocked
+                print(f"❌ Load failed for {staged}: {e}")
+                failures.append(e)
+                if not isinstance(e, Exception):
+                    fatal.append(e)
+
+    stages = [threading.Thread(target=transform_stage, name="transform"),
+              threading.Thread(target=load_stage, name="load")]
+    for stage in stages:
+        stage.start()
+
+    print("\n[1-3/4] 🚀 Extract → 🔁 Transform → 📦 Load (overlapped)...")
+    raw_files = []
+    try:
+        raw_files = extract_atmos_data(on_file=raw_queue.put, session=session)
+    except Exception as e:
+        print(f"❌ Critical Error in Extract: {e}")
+        failures.append(e)
+    finally:
+        raw_queue.put(None)
+        for stage in stages:
+            stage.join()
+
+    # Surface a stage's SystemExit/KeyboardInterrupt as if it had been raised here
+    if fatal:
+        raise fatal[0]
+    if not raw_files:
+        print("❌ Extraction failed or returned no files. Stopping.")
+        raise PipelineError("Extraction returned no files")
+    if failures and not loaded:
+        print("❌ Nothing was loaded. Stopping.")
+        raise PipelineError(f"Nothing was loaded ({len(failures)} errors)")
+
+    print("\n[4/4] 📊 Running Analysis & Generating Reports...")
+    try:
+        run_analysis()
+    except Exception as e:
+        print(f"❌ Critical Error in Analysis: {e}")
+        raise PipelineError(f"Analysis: {e}") from e
+
+    print("\n===================================================")
+    print(f"✅ PIPELINE COMPLETED ({len(loaded)} staged files loaded, {len(failures)} errors)")
+    print("===================================================")
+
 if __name__ == "__main__":
-    run_full_pipeline()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="AtmosTrack ETL pipeline")
+    parser.add_argument("--stream", action="store_true", default=STREAM_PIPELINE,
+                        help="overlap extract/transform/load with bounded queues")
+    parser.add_argument("--profile", action="store_true",
+                        help="run under cProfile and save the stats to data/metrics")
+    parser.add_argument("--compact", action="store_true", default=COMPACT_AFTER_RUN,
+                        help="fold raw/staged files into the partitioned archive after the run")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running, one cycle per DAEMON_INTERVAL, with a local status endpoint")
+    args = parser.parse_args()
+    try:
+        if args.daemon:
+            from daemon import run_daemon
+            run_daemon(stream=args.stream, compact=args.compact)
+        else:
+            # Share the daemon's lock so a cron run never overlaps a running cycle
+            from daemon import RunLock
+            lock = RunLock()
+            if not lock.acquire():
+                print("⏭️  Another pipeline run is in progress, exiting.")
+                sys.exit(0)
+            try:
+                if args.profile:
+                    profile_pipeline(stream=args.stream, compact=args.compact)
+                else:
+                    run_full_pipeline(stream=args.stream, compact=args.compact)
+            finally:
+                lock.release()
+    except PipelineError:
+        sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,103 @@
+# schema.py
+import numpy as np
+import pandas as pd
+
+POLLUTANTS = ["pm10", "pm2_5", "carbon_monoxide", "nitrogen_dioxide", "sulphur_dioxide", "ozone", "uv_index"]
+
+# Averaged indicators added by rolling.py (24h PM, 8h O3/CO, PM NowCast)
+ROLLING_COLUMNS = ["pm2_5_24h", "pm10_24h", "ozone_8h", "carbon_monoxide_8h", "pm2_5_nowcast", "pm10_nowcast"]
+
+# One in-memory schema for transform, load and analysis frames. Labels repeat on
+# every row, so they are categoricals; pollutant readings carry at most a few
+# significant digits, so float32 holds them exactly (see `widen_floats`).
+# The derived severity score stays float64 so stored values are unchanged.
+SCHEMA = {
+    "id": "int64",
+    "city": "category",
+    "time": "datetime64",
+    "hour": "int8",
+    **{col: "float32" for col in POLLUTANTS},
+    "aqi_category": "category",
+    "severity_score": "float64",
+    "risk_classification": "category",
+    "risk_flag": "category",
+    **{col: "float32" for col in ROLLING_COLUMNS},
+}
+
+def apply_schema(df):
+    """Casts the known columns of `df` to SCHEMA (other columns are left alone)."""
+    for col, dtype in SCHEMA.items():
+        if col not in df.columns:
+            continue
+        values = df[col]
+        if dtype == "datetime64":
+            if not pd.api.types.is_datetime64_any_dtype(values):
+                df[col] = pd.to_datetime(values, errors="coerce")
+            continue
+        if dtype == "category":
+            # Observed labels, sorted, whatever the source (pd.cut, csv, parquet dictionary)
+            categories = sorted(values.dropna().unique())
+            df[col] = values.astype(pd.CategoricalDtype(categories))
+            continue
+        if values.dtype == object:
+            values = pd.to_numeric(values, errors="coerce")
+        if dtype.startswith("int") and values.isna().any():
+            dtype = dtype.capitalize()  # nullable Int8/Int64 when a value is missing
+        df[col] = values.astype(dtype)
+    return df
+
+def arrow_schema(fields, dictionaries=True):
+    """
+    Arrow schema for the staged columns in `fields`, typed from SCHEMA rather than
+    from the values of one chunk (a label column with no values in it would be
+    typed null). Labels are dictionary-encoded or plain strings; columns outside
+    SCHEMA keep their type.
+    """
+    import pyarrow as pa
+
+    types = {
+        "category": pa.dictionary(pa.int32(), pa.large_string()) if dictionaries else pa.large_string(),
+        "datetime64": pa.timestamp("us"),
+    }
+    return pa.schema([
+        field.with_type(types.get(SCHEMA[field.name]) or pa.from_numpy_dtype(np.dtype(SCHEMA[field.name])))
+        if field.name in SCHEMA else field
+        for field in fields
+    ])
+
+def float32_to_float64(values):
+    """
+    Widens float32 values to the float64 of their shortest decimal form, so
+    47.3 is written as 47.3 and not 47.29999923706055 (same digits numpy's
+    repr of the float32 prints).
+    """
+    x32 = np.asarray(values, dtype=np.float32)
+    x = x32.astype(np.float64)
+    out = x.copy()
+    todo = np.isfinite(x) & (x != 0)
+    exponent = np.zeros(len(x), dtype=np.int64)
+    exponent[todo] = np.floor(np.log10(np.abs(x[todo])))
+
+    # Fewest significant digits that round-trip to the same float32 (9 always does)
+    for digits in (6, 7, 8, 9):
+        idx = np.flatnonzero(todo)
+        if not len(idx):
+            break
+        shift = digits - 1 - exponent[idx]
+        scale = 10.0 ** np.abs(shift)
+        v = x[idx]
+        rounded = np.where(shift >= 0, np.round(v * scale) / scale, np.round(v / scale) * scale)
+        ok = rounded.astype(np.float32) == x32[idx]
+        out[idx[ok]] = rounded[ok]
+        todo[idx[ok]] = False
+    return out
+
+def widen_floats(df):
+    """Copy of `df` with float32 columns widened to float64 for serialization or exact sums."""
+    narrow = [col for col in df.columns if df[col].dtype == np.float32]
+    if not narrow:
+        return df
+    df = df.copy()
+    for col in narrow:
+        df[col] = float32_to_float64(df[col].to_numpy())
+    return df
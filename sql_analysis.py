@@ -0,0 +1,67 @@
+# sql_analysis.py
+import pandas as pd
+from schema import apply_schema
+
+# Analysis queries for the SQL backends: the local DuckDB store and Postgres over
+# DATABASE_URL. Every query names its table as {table}, filled in per engine.
+TABLE_NAME = "air_quality_data"
+TABLES = {"duckdb": TABLE_NAME, "postgres": f"public.{TABLE_NAME}"}
+
+# One query per KPI input, same shape as the Supabase analysis views
+AGGREGATE_QUERIES = {
+    "city_stats": """
+        SELECT city, AVG(pm2_5) AS avg_pm25, MAX(severity_score) AS max_severity, COUNT(*) AS n_rows
+        FROM {table} WHERE city IS NOT NULL GROUP BY city ORDER BY city
+    """,
+    "hour_stats": """
+        SELECT hour, AVG(pm2_5) AS avg_pm25
+        FROM {table} WHERE hour IS NOT NULL GROUP BY hour ORDER BY hour
+    """,
+    "risk_rows": """
+        SELECT city, risk_flag, COUNT(*) AS n
+        FROM {table} WHERE city IS NOT NULL AND risk_flag IS NOT NULL
+        GROUP BY city, risk_flag ORDER BY city, risk_flag
+    """,
+    "top_event": """
+        SELECT city, severity_score FROM {table}
+        ORDER BY severity_score DESC NULLS LAST LIMIT 1
+    """,
+}
+
+# Rows of selected columns, limited to the last {days} days up to the latest row
+ROWS_QUERY = "SELECT {columns} FROM {table}{window} ORDER BY city, time"
+WINDOW_FILTER = " WHERE time >= (SELECT MAX(time) FROM {table}) - INTERVAL '{days} days'"
+
+def query_frames(backend, queries):
+    """Runs each query against `backend` ("duckdb" or "postgres"); name -> DataFrame."""
+    table = TABLES[backend]
+    if backend == "duckdb":
+        from local_store import connect
+
+        with connect() as con:
+            return {name: con.execute(sql.format(table=table)).df() for name, sql in queries.items()}
+
+    import psycopg
+    from load import DATABASE_URL
+
+    if not DATABASE_URL:
+        raise SystemExit("Please check .env for DATABASE_URL (LOAD_BACKEND=postgres)")
+    frames = {}
+    with psycopg.connect(DATABASE_URL) as conn, conn.cursor() as cur:
+        for name, sql in queries.items():
+            cur.execute(sql.format(table=table))
+            frames[name] = pd.DataFrame(cur.fetchall(), columns=[col.name for col in cur.description])
+    return frames
+
+def query_aggregates(backend):
+    """Same aggregates as the Supabase analysis views, computed by the SQL backend."""
+    frames = query_frames(backend, AGGREGATE_QUERIES)
+    return frames["city_stats"], frames["hour_stats"], frames["risk_rows"], frames["top_event"].to_dict(orient="records")
+
+def query_rows(backend, columns, days=None):
+    """Selected table columns (the last `days` days up to the latest row; every row when None)."""
+    from pg_load import COPY_COLUMNS
+
+    window = WINDOW_FILTER.format(table="{table}", days=int(days)) if days else ""
+    sql = ROWS_QUERY.format(columns=", ".join(c for c in columns if c in COPY_COLUMNS), table="{table}", window=window)
+    return apply_schema(query_frames(backend, {"rows": sql})["rows"])
@@ -1,63 +1,176 @@
 # transform.py
-import json
+import os
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 from datetime import datetime
+from watermark import filter_new_rows, load_watermarks
+from jsonio import read_json
+from instrumentation import stage
+from schema import POLLUTANTS, apply_schema, arrow_schema
+from rolling import add_rolling_features, load_tails, merge_tails
 
 BASE_DIR = Path(__file__).resolve().parents[0]
 STAGED_DIR = BASE_DIR / "data" / "staged"
 STAGED_DIR.mkdir(parents=True, exist_ok=True)
 
+# Staging format: csv (default), parquet or feather (Arrow IPC)
+STAGING_FORMAT = os.getenv("STAGING_FORMAT", "csv").lower()
+STAGED_SUFFIXES = {"csv": ".csv", "parquet": ".parquet", "feather": ".arrow"}
+
+# Streaming mode settings (override via .env / environment)
+STREAM_TRANSFORM = os.getenv("TRANSFORM_STREAM", "0") == "1"
+STREAM_CHUNK_ROWS = int(os.getenv("TRANSFORM_CHUNK_ROWS", "50000"))
+
+# Process-pool workers for the transform (1 = serial)
+TRANSFORM_WORKERS = int(os.getenv("TRANSFORM_WORKERS", "1"))
+
+# Breakpoint tables: (inclusive upper bound, label), ascending.
+# Swap in official CPCB sub-index breakpoints here without touching the transform.
+AQI_BREAKPOINTS = [
+    (50, "Good"),
+    (100, "Moderate"),
+    (200, "Unhealthy"),
+    (300, "Very Unhealthy"),
+    (np.inf, "Hazardous"),
+]
+RISK_BREAKPOINTS = [
+    (200, "Low Risk"),
+    (400, "Moderate Risk"),
+    (np.inf, "High Risk"),
+]
+RISK_DEFAULT = "Low Risk"  # Missing severity counts as low risk
+
+def classify(values, breakpoints, default=None):
+    """Vectorized binning of a Series against a breakpoint table (categorical result)."""
+    bins = [-np.inf] + [upper for upper, _ in breakpoints]
+    labels = [label for _, label in breakpoints]
+    result = pd.cut(values, bins=bins, labels=labels, right=True, include_lowest=True)
+    if default is not None:
+        result = result.fillna(default)
+    return result
+
 def calculate_aqi_category(pm25):
     """Classifies AQI based on PM2.5 levels."""
     if pd.isna(pm25): return None
-    if pm25 <= 50: return "Good"
-    if pm25 <= 100: return "Moderate"
-    if pm25 <= 200: return "Unhealthy"
-    if pm25 <= 300: return "Very Unhealthy"
-    return "Hazardous"
+    for upper, label in AQI_BREAKPOINTS:
+        if pm25 <= upper: return label
 
 def calculate_risk(score):
     """Classifies risk based on Severity Score."""
-    if pd.isna(score): return "Low Risk"
-    if score > 400: return "High Risk"
-    if score > 200: return "Moderate Risk"
-    return "Low Risk"
+    if pd.isna(score): return RISK_DEFAULT
+    for upper, label in RISK_BREAKPOINTS:
+        if score <= upper: return label
 
-def transform_data(raw_files):
-    print("🔁 Starting Transformation...")
-    dfs = []
-    
-    for path in raw_files:
-        try:
-            with open(path, "r") as f:
-                payload = json.load(f)
-            
-            # Open-Meteo structure: {'hourly': {'time': [], 'pm10': []...}}
-            hourly_data = payload.get("hourly", {})
-            if not hourly_data: continue
-            
-            df = pd.DataFrame(hourly_data)
-            df["city"] = payload.get("city_name", "Unknown")
-            dfs.append(df)
-        except Exception as e:
-            print(f"⚠️ Failed to process {path}: {e}")
+def write_staged(df, path):
+    """Writes the staged frame in the format implied by the file suffix."""
+    suffix = Path(path).suffix
+    if suffix == ".parquet":
+        # Categoricals become dictionary-encoded columns, time a native timestamp
+        df.to_parquet(path, index=False)
+    elif suffix == ".arrow":
+        df.reset_index(drop=True).to_feather(path)
+    else:
+        df.to_csv(path, index=False)
 
-    if not dfs:
-        print("❌ No data to transform.")
+def read_staged(path):
+    """Reads a staged file written by `write_staged`, typed per the shared schema."""
+    suffix = Path(path).suffix
+    if suffix == ".parquet":
+        df = pd.read_parquet(path)
+    elif suffix == ".arrow":
+        df = pd.read_feather(path)
+    else:
+        df = pd.read_csv(path)
+    return apply_schema(df)
+
+def list_staged_files():
+    """All staged files (any format), oldest first."""
+    suffixes = set(STAGED_SUFFIXES.values())
+    files = [p for p in STAGED_DIR.glob("air_quality_transform_*") if p.suffix in suffixes]
+    return sorted(str(p) for p in files)
+
+class StagedWriter:
+    """Appends transformed chunks to a single staged file (csv, parquet or arrow)."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.writer = None
+        self.rows = 0
+
+    def write(self, df):
+        if df.empty:
+            return
+        if self.path.suffix == ".csv":
+            df.to_csv(self.path, index=False, mode="a" if self.rows else "w", header=not self.rows)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.writer is None:
+                # Each chunk has its own categories: parquet takes per-row-group dictionaries
+                # (index width fixed at int32), arrow files allow only one per field, so
+                # labels go in as plain strings there and read_staged re-categorizes them
+                self.schema = arrow_schema(table.schema, dictionaries=self.path.suffix == ".parquet")
+                if self.path.suffix == ".parquet":
+                    self.writer = pq.ParquetWriter(self.path, self.schema)
+                else:
+                    self.writer = pa.ipc.new_file(self.path, self.schema)
+            self.writer.write_table(table.cast(self.schema))
+        self.rows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+def read_raw_file(path):
+    """Parses one raw JSON payload into an hourly DataFrame tagged with its city."""
+    try:
+        # Plain, compact or gzip/zstd-compressed JSON all read the same way
+        payload = read_json(path)
+
+        # Open-Meteo structure: {'hourly': {'time': [], 'pm10': []...}}
+        hourly_data = payload.get("hourly", {})
+        if not hourly_data: return None
+
+        df = pd.DataFrame(hourly_data)
+        df["city"] = payload.get("city_name", "Unknown")
+        return df
+    except Exception as e:
+        print(f"⚠️ Failed to process {path}: {e}")
         return None
 
-    # Merge all cities
-    df_combined = pd.concat(dfs, ignore_index=True)
+def ensure_pollutant_columns(df):
+    """Adds missing pollutant columns as NaN, as pd.concat would across cities."""
+    for col in POLLUTANTS:
+        if col not in df.columns:
+            df[col] = np.nan
+    return df
+
+def transform_file(path, watermarks=None):
+    """Parses and feature-engineers one raw file (process-pool worker)."""
+    df = read_raw_file(path)
+    if df is None:
+        return None
+    return engineer_features(ensure_pollutant_columns(df), watermarks)
 
+def engineer_features(df_combined, watermarks=None):
+    """Cleans raw hourly rows and adds AQI, severity and risk features."""
     # --- A. Data Cleaning & Renaming ---
     # Convert 'time' to datetime
     if "time" in df_combined.columns:
         df_combined["time"] = pd.to_datetime(df_combined["time"])
     
+    # Skip hours already loaded in a previous run
+    df_combined = filter_new_rows(df_combined, watermarks)
+    if df_combined.empty:
+        return df_combined
+
     # Ensure all pollutant columns are numeric
-    pollutants = ["pm10", "pm2_5", "carbon_monoxide", "nitrogen_dioxide", "sulphur_dioxide", "ozone", "uv_index"]
+    pollutants = POLLUTANTS
     for col in pollutants:
         if col in df_combined.columns:
             # Replace dots with underscores in col names just in case (api returns pm2_5 usually)
@@ -69,7 +182,7 @@ def transform_data(raw_files):
     # --- B. Feature Engineering ---
     
     # 1. AQI based on PM2.5
-    df_combined["aqi_category"] = df_combined["pm2_5"].apply(calculate_aqi_category)
+    df_combined["aqi_category"] = classify(df_combined["pm2_5"], AQI_BREAKPOINTS)
 
     # 2. Pollution Severity Score
     # Formula: (pm2_5 * 5) + (pm10 * 3) + (no2 * 4) + (so2 * 4) + (co * 2) + (o3 * 3)
@@ -83,21 +196,157 @@ def transform_data(raw_files):
     )
 
     # 3. Risk Classification
-    df_combined["risk_classification"] = df_combined["severity_score"].apply(calculate_risk)
+    df_combined["risk_classification"] = classify(df_combined["severity_score"], RISK_BREAKPOINTS, RISK_DEFAULT)
 
     # 4. Temperature Hour-of-Day Feature
     df_combined["hour"] = df_combined["time"].dt.hour
 
-    # --- C. Save Staged Data ---
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    staged_path = STAGED_DIR / f"air_quality_transform_{timestamp}.csv"
-    
     # Select specific columns to keep it clean (reordering)
     final_cols = ["city", "time", "hour"] + pollutants + ["aqi_category", "severity_score", "risk_classification"]
     # Filter only existing columns
     final_cols = [c for c in final_cols if c in df_combined.columns]
+    # Compact dtypes from here on: categorical labels, float32 readings, int8 hour
+    return apply_schema(df_combined[final_cols])
+
+def staged_file_path(staging_format, tag=None):
+    if staging_format not in STAGED_SUFFIXES:
+        raise ValueError(f"Unknown staging format '{staging_format}', expected one of {list(STAGED_SUFFIXES)}")
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    # `tag` keeps several files staged within the same second apart
+    name = f"air_quality_transform_{timestamp}" + (f"_{tag}" if tag else "")
+    return STAGED_DIR / f"{name}{STAGED_SUFFIXES[staging_format]}"
+
+def transform_data(raw_files, staging_format=STAGING_FORMAT, stream=STREAM_TRANSFORM, chunk_rows=STREAM_CHUNK_ROWS,
+                   workers=TRANSFORM_WORKERS, tag=None):
+    raw_files = list(raw_files)
+    mode = "stream" if stream else "parallel" if workers > 1 else "batch"
+    with stage("transform", mode=mode, files=len(raw_files)) as metrics:
+        metrics["bytes"] = sum(Path(path).stat().st_size for path in raw_files if Path(path).exists())
+        if stream:
+            staged = transform_data_streaming(raw_files, staging_format, chunk_rows, tag, metrics)
+        elif workers > 1:
+            staged = transform_data_parallel(raw_files, staging_format, workers, tag, metrics)
+        else:
+            staged = transform_data_batch(raw_files, staging_format, tag, metrics)
+        if staged:
+            metrics["bytes_out"] = Path(staged).stat().st_size
+    return staged
+
+def transform_data_batch(raw_files, staging_format=STAGING_FORMAT, tag=None, metrics=None):
+    print("🔁 Starting Transformation...")
+    dfs = []
     
-    df_combined[final_cols].to_csv(staged_path, index=False)
+    for path in raw_files:
+        df = read_raw_file(path)
+        if df is not None:
+            dfs.append(df)
+
+    if not dfs:
+        print("❌ No data to transform.")
+        return None
+
+    # Merge all cities
+    df_combined = engineer_features(pd.concat(dfs, ignore_index=True))
+    if metrics is not None:
+        metrics["rows"] = len(df_combined)
+    if df_combined.empty:
+        print("ℹ️  No new rows since last watermark.")
+        return None
+    df_combined = add_rolling_features(df_combined)
+
+    # --- C. Save Staged Data ---
+    staged_path = staged_file_path(staging_format, tag)
+    write_staged(df_combined, staged_path)
+    print(f"✅ Transformed data saved: {staged_path}")
+    return str(staged_path)
+
+def transform_data_streaming(raw_files, staging_format=STAGING_FORMAT, chunk_rows=STREAM_CHUNK_ROWS, tag=None,
+                             metrics=None):
+    """
+    Memory-bounded variant of `transform_data`: raw files are parsed and
+    transformed in chunks of ~`chunk_rows` rows and appended to the staged file,
+    so peak memory no longer grows with the size of the backlog.
+    """
+    print(f"🔁 Starting Streaming Transformation (chunks of {chunk_rows} rows)...")
+    staged_path = staged_file_path(staging_format, tag)
+    writer = StagedWriter(staged_path)
+    watermarks = load_watermarks()
+    history = load_tails()
+    buffer, buffered_rows, parsed = [], 0, 0
+
+    def flush():
+        nonlocal history
+        chunk = ensure_pollutant_columns(pd.concat(buffer, ignore_index=True))
+        features = engineer_features(chunk, watermarks)
+        if not features.empty:
+            # Later chunks' windows reach back into this one (same overlap rule as batch)
+            features = add_rolling_features(features, history)
+            history = merge_tails(history, features, watermarks)
+        writer.write(features)
+        buffer.clear()
+
+    try:
+        for path in raw_files:
+            df = read_raw_file(path)
+            if df is None:
+                continue
+            parsed += 1
+            buffer.append(df)
+            buffered_rows += len(df)
+            if buffered_rows >= chunk_rows:
+                flush()
+                buffered_rows = 0
+        if buffer:
+            flush()
+    finally:
+        writer.close()
+
+    if metrics is not None:
+        metrics["rows"] = writer.rows
+    if not parsed:
+        print("❌ No data to transform.")
+        return None
+    if not writer.rows:
+        print("ℹ️  No new rows since last watermark.")
+        staged_path.unlink(missing_ok=True)
+        return None
+
+    print(f"✅ Transformed data saved: {staged_path} ({writer.rows} rows)")
+    return str(staged_path)
+
+def transform_data_parallel(raw_files, staging_format=STAGING_FORMAT, workers=TRANSFORM_WORKERS, tag=None,
+                            metrics=None):
+    """
+    Multi-core variant of `transform_data`: each raw file is parsed and
+    feature-engineered in a worker process, and results are merged in
+    `raw_files` order so the staged output matches the serial path.
+    """
+    print(f"🔁 Starting Parallel Transformation ({workers} workers)...")
+    raw_files = list(raw_files)
+    watermarks = load_watermarks()
+    chunksize = max(1, len(raw_files) // (workers * 4))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # map() yields in submission order, keeping the merge deterministic
+        results = list(pool.map(partial(transform_file, watermarks=watermarks), raw_files, chunksize=chunksize))
+
+    frames = [df for df in results if df is not None]
+    if not frames:
+        print("❌ No data to transform.")
+        return None
+
+    frames = [df for df in frames if not df.empty]
+    if metrics is not None:
+        metrics["rows"] = sum(len(df) for df in frames)
+    if not frames:
+        print("ℹ️  No new rows since last watermark.")
+        return None
+
+    # Per-file categories differ, so the merged frame is re-typed once; windows
+    # can span files, so they are computed here rather than in the workers
+    df_combined = add_rolling_features(apply_schema(pd.concat(frames, ignore_index=True)))
+    staged_path = staged_file_path(staging_format, tag)
+    write_staged(df_combined, staged_path)
     print(f"✅ Transformed data saved: {staged_path}")
     return str(staged_path)
 
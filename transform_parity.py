@@ -0,0 +1,93 @@
+# transform_parity.py
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# bench keeps every bit of pipeline state in a scratch directory
+from bench import SCRATCH, reset_state, synthetic_payload
+import transform
+from jsonio import write_json
+from rolling import update_tails
+from transform import read_staged, transform_data
+from watermark import update_watermarks
+
+# Overlapping raw files: PARITY_RUNS payloads per city, each starting a day after
+# the previous one and revising the hours they share (like successive runs)
+PARITY_CITIES = int(os.getenv("PARITY_CITIES", "6"))
+PARITY_HOURS = int(os.getenv("PARITY_HOURS", "120"))  # one 5-day forecast payload
+PARITY_RUNS = int(os.getenv("PARITY_RUNS", "3"))
+
+# Every variant must stage exactly what the batch transform stages
+MODES = {
+    "batch": {},
+    "stream (chunks of 100 rows)": {"stream": True, "chunk_rows": 100},
+    "stream (chunks of 1000 rows)": {"stream": True, "chunk_rows": 1000},
+    "stream (one chunk)": {"stream": True, "chunk_rows": 10 ** 9},
+    "parallel (2 workers)": {"workers": 2},
+    "parallel (3 workers)": {"workers": 3},
+}
+
+def overlapping_raw(run, cities=PARITY_CITIES, hours=PARITY_HOURS, runs=PARITY_RUNS, seed=7):
+    """Raw files for `runs` successive runs starting at day `run`, cities interleaved."""
+    rng = np.random.default_rng(seed + run)
+    out_dir = SCRATCH / "parity_raw"
+    out_dir.mkdir(exist_ok=True)
+    files = []
+    for day in range(run, run + runs):
+        start = (pd.Timestamp("2025-01-01") + pd.Timedelta(days=day)).strftime("%Y-%m-%dT%H:%M")
+        for i in range(cities):
+            payload = synthetic_payload(f"City{i:02d}", hours, rng, start=start)
+            files.append(str(write_json(out_dir / f"city{i:02d}_raw_{day:03d}.json", payload)))
+    return files
+
+def staged_frames(files, setup=None):
+    """Staged output of every mode, each starting from the same pipeline state."""
+    frames = {}
+    for name, options in MODES.items():
+        reset_state()
+        if setup:
+            setup()
+        staged = transform_data(files, tag=f"parity_{len(frames)}", **options)
+        frames[name] = read_staged(staged).reset_index(drop=True) if staged else None
+    return frames
+
+def differing_rows(a, b):
+    if a is None or b is None or len(a) != len(b) or list(a.columns) != list(b.columns):
+        return None
+    same = np.ones(len(a), dtype=bool)
+    for col in a.columns:
+        x, y = a[col].astype(object).to_numpy(), b[col].astype(object).to_numpy()
+        same &= (x == y) | (pd.isna(x) & pd.isna(y))
+    return int((~same).sum())
+
+def check_scenario(title, files, setup=None):
+    print(f"\n🔬 {title}")
+    frames = staged_frames(files, setup)
+    reference = frames["batch"]
+    ok = reference is not None
+    for name, frame in frames.items():
+        if name == "batch":
+            continue
+        diff = differing_rows(reference, frame)
+        status = "✅" if diff == 0 else "❌"
+        detail = "shape differs" if diff is None else f"{diff} rows differ"
+        print(f"{status} {name}: {0 if frame is None else len(frame)} rows, {detail}")
+        ok = ok and diff == 0
+    return ok
+
+def carry_over():
+    """State after an earlier run was staged and loaded: watermarks and rolling tails."""
+    staged = read_staged(transform_data(overlapping_raw(0), tag="parity_prev"))
+    update_watermarks(staged)
+    update_tails(staged)
+
+def check_transform_parity():
+    transform.STAGED_DIR = SCRATCH / "staged"
+    transform.STAGED_DIR.mkdir(exist_ok=True)
+    ok = check_scenario("Overlapping files, fresh state", overlapping_raw(0))
+    ok = check_scenario("Overlapping files on top of an earlier run", overlapping_raw(1), carry_over) and ok
+    return ok
+
+if __name__ == "__main__":
+    sys.exit(0 if check_transform_parity() else 1)
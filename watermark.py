@@ -0,0 +1,91 @@
+# watermark.py
+import json
+import os
+import pandas as pd
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from jsonio import write_json_atomic
+
+BASE_DIR = Path(__file__).resolve().parents[0]
+# Pipeline state (watermarks, rollups, rolling tails...), shared by every module that keeps some
+STATE_DIR = BASE_DIR / "data" / "state"
+STATE_DIR.mkdir(parents=True, exist_ok=True)
+
+WATERMARK_FILE = Path(os.getenv("WATERMARK_FILE", STATE_DIR / "watermarks.json"))
+UTC_OFFSET_FILE = Path(os.getenv("UTC_OFFSET_FILE", STATE_DIR / "utc_offsets.json"))
+
+# Row times are local to each city. Until extract has seen a city's UTC offset, the
+# westernmost zone is assumed so a forecast hour is never mistaken for a past one.
+DEFAULT_UTC_OFFSET = -12 * 3600
+
+# Open-Meteo default forecast horizon: a run without a watermark fetches this many
+# days from its own date, later runs fetch from the watermark's date on
+FORECAST_DAYS = 5
+
+# Same format Open-Meteo uses for hourly timestamps (timezone=auto -> local, no offset)
+TIME_FORMAT = "%Y-%m-%dT%H:%M"
+
+def load_watermarks():
+    """Returns {city: last loaded time} from the state file."""
+    if not WATERMARK_FILE.exists():
+        return {}
+    try:
+        raw = json.loads(WATERMARK_FILE.read_text())
+        return {city: datetime.strptime(ts, TIME_FORMAT) for city, ts in raw.items()}
+    except Exception as e:
+        print(f"⚠️ Could not read watermarks ({e}), starting from scratch.")
+        return {}
+
+def save_watermarks(watermarks):
+    data = {city: ts.strftime(TIME_FORMAT) for city, ts in sorted(watermarks.items())}
+    write_json_atomic(WATERMARK_FILE, data, indent=2)
+
+def load_utc_offsets():
+    """Returns {city: UTC offset in seconds} as reported by the API."""
+    if not UTC_OFFSET_FILE.exists():
+        return {}
+    try:
+        return json.loads(UTC_OFFSET_FILE.read_text())
+    except Exception as e:
+        print(f"⚠️ Could not read UTC offsets ({e}), assuming UTC{DEFAULT_UTC_OFFSET // 3600:+d}.")
+        return {}
+
+def record_utc_offsets(offsets):
+    """Stores the `utc_offset_seconds` of freshly fetched payloads ({city: seconds})."""
+    known = load_utc_offsets()
+    known.update({city: int(seconds) for city, seconds in offsets.items() if seconds is not None})
+    write_json_atomic(UTC_OFFSET_FILE, known, indent=2, sort_keys=True)
+
+def current_hour(offset, now=None):
+    """Start of the current hour in local time for a UTC offset (naive, like the row times)."""
+    now = datetime.now(timezone.utc) if now is None else now
+    local = now.astimezone(timezone.utc).replace(tzinfo=None) + timedelta(seconds=offset)
+    return local.replace(minute=0, second=0, microsecond=0)
+
+def filter_new_rows(df, watermarks=None):
+    """Drops rows at or below each city's watermark."""
+    watermarks = load_watermarks() if watermarks is None else watermarks
+    if df.empty or not watermarks:
+        return df
+    cutoff = df["city"].map(watermarks)
+    times = pd.to_datetime(df["time"])
+    return df[cutoff.isna() | (times > pd.to_datetime(cutoff))]
+
+def update_watermarks(df, now=None):
+    """
+    Advances each city's watermark to the latest time in `df`, but never past
+    the city's current hour: later rows are forecasts that each run refreshes.
+    """
+    if df is None or df.empty:
+        return
+    watermarks = load_watermarks()
+    offsets = load_utc_offsets()
+    latest = pd.to_datetime(df["time"]).groupby(df["city"], observed=True).max()
+    for city, ts in latest.items():
+        if pd.isna(ts):
+            continue
+        ts = min(ts.to_pydatetime(), current_hour(offsets.get(city, DEFAULT_UTC_OFFSET), now))
+        if city not in watermarks or ts > watermarks[city]:
+            watermarks[city] = ts
+    save_watermarks(watermarks)
+    print(f"🔖 Watermarks updated for {len(latest)} cities.")